@@ -0,0 +1,434 @@
+"""
+Нагрузочный тест API склада.
+
+Seeds a throwaway SQLite database with realistic volumes, drives the FastAPI app
+in-process over ASGI with a concurrent mix of requests and prints throughput and
+p50/p95/p99 latency per endpoint as JSON, so runs can be compared between commits:
+
+    python benchmark.py --items 50000 --operations 200000 --requests 5000 --output before.json
+    python benchmark.py --items 50000 --operations 200000 --requests 5000 --compare before.json
+
+With --workers N the app runs as N uvicorn processes on the same database (see
+workers.py) and is driven over HTTP on localhost instead, e.g. to compare read
+throughput of one worker against one per core:
+
+    python benchmark.py --workers 1 --mix scan=80,listing=20 --output one.json
+    python benchmark.py --workers 4 --mix scan=80,listing=20 --compare one.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+SCENARIOS = ("scan", "operation", "listing", "registration", "locations", "search")
+DEFAULT_MIX = "scan=55,operation=25,listing=10,locations=5,search=3,registration=2"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест API склада")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--locations", type=int, default=20)
+    parser.add_argument("--items", type=int, default=10000)
+    parser.add_argument("--operations", type=int, default=50000)
+    parser.add_argument("--requests", type=int, default=2000, help="всего запросов в прогоне")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="веса сценариев, например scan=60,operation=40")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=0, help="запустить N процессов uvicorn и нагружать их по HTTP")
+    parser.add_argument("--db", help="путь к файлу БД (по умолчанию временный)")
+    parser.add_argument("--output", help="записать результат в JSON-файл")
+    parser.add_argument("--compare", help="сравнить с предыдущим JSON-результатом")
+    return parser.parse_args()
+
+
+def parse_mix(spec: str):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise SystemExit(f"Неизвестный сценарий: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class ASGIClient:
+    """Минимальный HTTP-клиент поверх ASGI: без сети и без сторонних зависимостей."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, params=None, json_body=None):
+        body = json.dumps(json_body).encode() if json_body is not None else b""
+        headers = [(b"host", b"bench")]
+        if json_body is not None:
+            headers += [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": urlencode(params or {}).encode(),
+            "root_path": "",
+            "headers": headers,
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+        }
+        sent = False
+        status = 500
+        chunks = []
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await asyncio.Event().wait()  # the app never needs a disconnect here
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        try:
+            await self.app(scope, receive, send)
+        except Exception as e:
+            # The server would have answered 500; the run goes on and counts it
+            return 500, str(e).encode()
+        return status, b"".join(chunks)
+
+
+class HTTPClient:
+    """Минимальный HTTP/1.1-клиент с keep-alive: по соединению на каждую параллельную задачу."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._idle = []
+
+    async def request(self, method: str, path: str, params=None, json_body=None):
+        body = json.dumps(json_body).encode() if json_body is not None else b""
+        target = f"{path}?{urlencode(params)}" if params else path
+        head = f"{method} {target} HTTP/1.1\r\nHost: {self.host}\r\nContent-Length: {len(body)}\r\n"
+        if json_body is not None:
+            head += "Content-Type: application/json\r\n"
+        try:
+            connection = self._idle.pop() if self._idle else await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            return 599, str(e).encode()
+        reader, writer = connection
+        try:
+            writer.write(head.encode() + b"\r\n" + body)
+            status, headers = await self._read_head(reader)
+            if headers.get("transfer-encoding") == "chunked":
+                payload = await self._read_chunked(reader)
+            else:
+                payload = await reader.readexactly(int(headers.get("content-length", 0)))
+        except (OSError, asyncio.IncompleteReadError) as e:
+            writer.close()
+            return 599, str(e).encode()
+        if headers.get("connection") == "close":
+            writer.close()
+        else:
+            self._idle.append(connection)
+        return status, payload
+
+    async def _read_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b"", None)
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+        return int(status_line.split()[1]), headers
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while size := int((await reader.readline()).split(b";")[0], 16):
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        await reader.readline()
+        return b"".join(chunks)
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_server(args, port: int):
+    """Запускает uvicorn с N процессами и ждет, пока он начнет отвечать."""
+    env = dict(os.environ, WEB_CONCURRENCY=str(args.workers))
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(args.workers), "--log-level", "warning", "--no-access-log",
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=sys.stderr,
+    )
+    client = HTTPClient("127.0.0.1", port)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise SystemExit(f"uvicorn завершился с кодом {process.returncode}")
+        status, _ = await client.request("GET", "/api/locations")
+        if status == 200:
+            await client.close()
+            return process
+        await asyncio.sleep(0.2)
+    process.terminate()
+    raise SystemExit("uvicorn не ответил за 60 с")
+
+
+async def stop_server(process):
+    process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), 30)
+    except asyncio.TimeoutError:
+        process.kill()
+
+
+def seed_database(path: str, args, rng: random.Random):
+    """Наполняет БД напрямую через sqlite3 executemany: схема уже создана init_db."""
+    started = time.perf_counter()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=OFF")
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (id, tg_id, username, role, is_active, created_at) "
+            "VALUES (?, ?, ?, 'worker', 1, CURRENT_TIMESTAMP)",
+            [(i, 1_000_000 + i, f"user{i}") for i in range(1, args.users + 1)],
+        )
+        conn.executemany(
+            "INSERT INTO locations (id, name, code) VALUES (?, ?, ?)",
+            [(i, f"Стеллаж {i}", f"LOC-{i:04d}") for i in range(1, args.locations + 1)],
+        )
+
+        stock = {}
+        items = []
+        operations = []
+        for item_id in range(1, args.items + 1):
+            location_id = rng.randint(1, args.locations)
+            items.append((
+                item_id, rng.randint(1, args.users), f"46{item_id:011d}", f"Товар {item_id} серия {item_id % 311}",
+                f"SKU-{item_id}", location_id,
+            ))
+            stock[(item_id, location_id)] = 0
+        item_locations = {item[0]: item[5] for item in items}
+        for op_id in range(1, args.operations + 1):
+            item_id = rng.randint(1, args.items)
+            location_id = item_locations[item_id]
+            quantity = rng.randint(1, 20)
+            stock[(item_id, location_id)] += quantity
+            operations.append((op_id, rng.randint(1, args.users), item_id, location_id, quantity))
+
+        conn.executemany(
+            "INSERT INTO items (id, user_id, barcode, name, sku, quantity, location_id, status, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, 0, ?, 'stored', CURRENT_TIMESTAMP)",
+            items,
+        )
+        conn.executemany(
+            "INSERT INTO operations (id, user_id, item_id, location_id, type, quantity, note, created_at) "
+            "VALUES (?, ?, ?, ?, 'receive', ?, '', CURRENT_TIMESTAMP)",
+            operations,
+        )
+        conn.executemany(
+            "INSERT INTO stock_levels (item_id, location_id, quantity, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+            [(item_id, location_id, qty) for (item_id, location_id), qty in stock.items() if qty],
+        )
+        conn.execute(
+            "UPDATE items SET quantity = coalesce((SELECT sum(quantity) FROM stock_levels WHERE item_id = items.id), 0), "
+            "last_operation_id = (SELECT max(id) FROM operations WHERE item_id = items.id)"
+        )
+    conn.execute("ANALYZE")
+    conn.close()
+    return round(time.perf_counter() - started, 3), item_locations
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(s[0] for s in samples)
+    errors = sum(1 for s in samples if s[1] >= 500)
+    rejected = sum(1 for s in samples if 400 <= s[1] < 500)
+    return {
+        "count": len(samples),
+        "errors_5xx": errors,
+        "client_errors_4xx": rejected,
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else None,
+        "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": latencies[-1] if latencies else None,
+    }
+
+
+async def run_load(client, args, mix, rng: random.Random, item_locations: dict):
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    next_tg_id = 10_000_000
+    remaining = args.requests
+    samples = {name: [] for name in names}
+
+    def next_request():
+        nonlocal next_tg_id
+        name = rng.choices(names, weights)[0]
+        item_id = rng.randint(1, args.items)
+        tg_id = 1_000_000 + rng.randint(1, args.users)
+        if name == "scan":
+            # Scans repeat a hot set of barcodes, with some unknown ones
+            barcode = f"46{rng.randint(1, min(args.items, 500)):011d}" if rng.random() < 0.9 else f"99{rng.randint(1, 10**9)}"
+            return name, "POST", "/api/items/scan", None, {"barcode": barcode}
+        if name == "operation":
+            op_type = rng.choices(["receive", "ship", "move", "inventory"], [45, 45, 5, 5])[0]
+            if op_type == "move":
+                # Partial move from the seeded location, which keeps the item's home in place
+                location_id = rng.randint(1, args.locations)
+                extra = {"from_location_id": item_locations[item_id]}
+            else:
+                location_id = item_locations[item_id]
+                extra = {}
+            return name, "POST", "/api/operations", None, {
+                "user_id": tg_id, "item_id": item_id, "location_id": location_id,
+                "type": op_type, "quantity": rng.randint(1, 3), **extra,
+            }
+        if name == "listing":
+            return name, "GET", f"/api/users/{tg_id}/items", {"limit": 50}, None
+        if name == "registration":
+            next_tg_id += 1
+            return name, "POST", "/api/register", None, {"tg_id": next_tg_id, "username": f"bench{next_tg_id}", "role": "worker"}
+        if name == "locations":
+            return name, "GET", "/api/locations", None, None
+        return name, "GET", "/api/items/search", {"q": f"серия {rng.randint(1, 310)}", "limit": 20}, None
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            name, method, path, params, body = next_request()
+            started = time.perf_counter()
+            status, _ = await client.request(method, path, params=params, json_body=body)
+            samples[name].append((round((time.perf_counter() - started) * 1000, 3), status))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    results = {name: summarize(s, elapsed) for name, s in samples.items() if s}
+    total = summarize([x for s in samples.values() for x in s], elapsed)
+    return elapsed, results, total
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous: dict, current: dict):
+    lines = []
+    for name, now in current["results"].items():
+        before = previous.get("results", {}).get(name)
+        if not before:
+            continue
+        parts = []
+        for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms"):
+            if before.get(key) and now.get(key) is not None:
+                parts.append(f"{key} {before[key]} -> {now[key]} ({(now[key] - before[key]) / before[key] * 100:+.1f}%)")
+        lines.append(f"{name}: " + ", ".join(parts))
+    return "\n".join(lines)
+
+
+async def main():
+    args = parse_args()
+    mix = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="sklad-bench-")
+    db_path = args.db or os.path.join(workdir, "bench.sqlite3")
+    # The engine is configured from the environment at import time
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{db_path}"
+    os.environ.setdefault("SLOW_REQUEST_MS", "0")
+    os.environ["SYNC_SINK"] = ""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as app_module
+
+    app = app_module.app
+    # The app prints to stdout; keep stdout for the JSON report only
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.workers:
+            # Schema and data first, then the server processes start on a ready database
+            await app_module.init_db()
+            await app_module.engine.dispose()
+            seed_seconds, item_locations = seed_database(db_path, args, rng)
+            port = free_port()
+            server = await start_server(args, port)
+            client = HTTPClient("127.0.0.1", port)
+            try:
+                elapsed, results, total = await run_load(client, args, mix, rng, item_locations)
+            finally:
+                await client.close()
+                await stop_server(server)
+        else:
+            async with app.router.lifespan_context(app):
+                seed_seconds, item_locations = seed_database(db_path, args, rng)
+                elapsed, results, total = await run_load(ASGIClient(app), args, mix, rng, item_locations)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "mix": mix,
+        },
+        "seed_seconds": seed_seconds,
+        "elapsed_seconds": round(elapsed, 3),
+        "results": results,
+        "total": total,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print(compare(json.load(f), report), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
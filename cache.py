@@ -0,0 +1,136 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+import orjson
+
+# Returned by TTLCache.get when the key is not cached (None is a valid cached value)
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Ограниченный LRU-кэш с временем жизни записей.
+
+    Values may be None, which is how misses are cached. `generation` is bumped on every
+    invalidation: a loader reads it before going to the DB and passes it back to `set`,
+    so a value loaded before a concurrent write is never stored over the invalidation.
+
+    With several worker processes, `share(path)` makes invalidations cross processes: an
+    invalidation touches the file at `path`, and a cache that sees the file's mtime change
+    drops everything it holds. It costs one stat() per lookup, and a write in one worker
+    empties the cache in the others, which then reload from the database.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.shared_path: str | None = None
+        self.shared_invalidations = 0
+        self._generation = 0
+        self._shared_mtime = None
+        self._data: OrderedDict = OrderedDict()
+
+    def share(self, path: str):
+        self.shared_path = path
+        with open(path, "ab"):
+            pass
+        self._shared_mtime = os.stat(path).st_mtime_ns
+
+    @property
+    def generation(self):
+        self._sync()
+        return self._generation
+
+    def _sync(self):
+        if self.shared_path is None:
+            return
+        mtime = os.stat(self.shared_path).st_mtime_ns
+        if mtime != self._shared_mtime:
+            # Another process invalidated something; which keys is not recorded
+            self._shared_mtime = mtime
+            self._generation += 1
+            self.shared_invalidations += 1
+            self._data.clear()
+
+    def _publish(self):
+        if self.shared_path is None:
+            return
+        self._sync()
+        stamp = time.time_ns()
+        os.utime(self.shared_path, ns=(stamp, stamp))
+        # Our own touch needs no clear here. If another process touched the file right
+        # after us, its mtime differs from the stamp and the next lookup clears.
+        if os.stat(self.shared_path).st_mtime_ns == stamp:
+            self._shared_mtime = stamp
+
+    def get(self, key):
+        self._sync()
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, generation: int | None = None):
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *keys):
+        self._generation += 1
+        for key in keys:
+            self._data.pop(key, None)
+        self._publish()
+
+    def clear(self):
+        self._generation += 1
+        self._data.clear()
+        self._publish()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "shared_invalidations": self.shared_invalidations,
+        }
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    Закэшированный ответ: готовое JSON-тело и значения для ETag и Last-Modified.
+
+    The body is rendered once when the data is loaded, cache hits send it as is. The ETag
+    is a hash of the body, so it stays the same when the data is reloaded unchanged;
+    last_modified is when this copy was loaded, truncated to HTTP's 1 s precision.
+    """
+    data: object
+    body: bytes
+    etag: str
+    last_modified: datetime = field(default_factory=lambda: datetime.now(timezone.utc).replace(microsecond=0))
+
+    @classmethod
+    def of(cls, data):
+        body = orjson.dumps(data)
+        return cls(data, body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"')
@@ -1,11 +1,109 @@
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
-from models import Base 
+from contextlib import asynccontextmanager
+import asyncio
+import os
+import random
+import time
+import weakref
+from dotenv import load_dotenv
+load_dotenv()
 
-DATABASE_URL = "sqlite+aiosqlite:///db.sqlite3"  
+# Единственный движок приложения, все параметры берутся из окружения (.env)
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///db.sqlite3")
+DB_ECHO = os.environ.get("DB_ECHO", "false").lower() in ("1", "true", "yes")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", "-64000"))  # negative value = KiB, i.e. ~64 MB
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", "5000"))  # ms
+# How long write_session keeps retrying for the write lock before giving up, seconds
+WRITE_LOCK_TIMEOUT = float(os.environ.get("WRITE_LOCK_TIMEOUT", "30"))
+WRITE_RETRY_BASE = float(os.environ.get("WRITE_RETRY_BASE", "0.01"))
+WRITE_RETRY_MAX = float(os.environ.get("WRITE_RETRY_MAX", "0.5"))
+
+engine_options = {"echo": DB_ECHO}
+# In-memory SQLite uses a static single-connection pool, sizing doesn't apply there
+if ":memory:" not in DATABASE_URL:
+    engine_options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+
+engine = create_async_engine(DATABASE_URL, **engine_options)
 async_session = async_sessionmaker(bind=engine, expire_on_commit=False)
 
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        # Applied once per new pool connection. WAL lets readers run alongside the writer.
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+
+# One asyncio.Lock per event loop, created on first use
+_write_locks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _process_write_lock():
+    loop = asyncio.get_running_loop()
+    lock = _write_locks.get(loop)
+    if lock is None:
+        lock = _write_locks[loop] = asyncio.Lock()
+    return lock
+
+
+async def begin_immediate(connection):
+    # busy_timeout already waits inside each attempt; on top of that the attempt is
+    # retried with jittered exponential backoff, without blocking the event loop
+    deadline = time.monotonic() + WRITE_LOCK_TIMEOUT
+    delay = WRITE_RETRY_BASE
+    while True:
+        try:
+            await connection.execute(text("BEGIN IMMEDIATE"))
+            return
+        except OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            if time.monotonic() + delay > deadline:
+                raise
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        delay = min(delay * 2, WRITE_RETRY_MAX)
+
+
+@asynccontextmanager
+async def write_session():
+    """
+    Сессия для транзакции с записью: единственный писатель на процесс, блокировка записи SQLite берется сразу.
+
+    A deferred SQLite transaction that reads first and then writes fails at once with
+    "database is locked" if another connection (or another uvicorn worker) committed in
+    between: the busy handler is not used for that lock upgrade. Here the write lock is
+    taken up front with BEGIN IMMEDIATE, so all waiting happens before the first
+    statement, with retries up to WRITE_LOCK_TIMEOUT. Tasks of the same process queue on
+    an asyncio.Lock instead of polling the database lock from several connections.
+    The lock is not reentrant: don't open a write_session inside another one.
+    """
+    async with _process_write_lock():
+        async with async_session() as session:
+            async with session.begin():
+                await begin_immediate(session)
+                yield session
+
+
 async def get_async_session():
     async with async_session() as session:
-        yield session
\ No newline at end of file
+        yield session
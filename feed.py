@@ -0,0 +1,277 @@
+"""
+Лента изменений остатков.
+
+In-process pub/sub: requests.py publishes a compact event after a stock change is
+committed, and every subscriber (an SSE connection, see main.py) receives the ones
+matching its item/location filter through its own bounded queue. A subscriber that
+falls behind is dropped rather than buffered without limit; it reconnects with the
+last event id it saw and gets the missed events from the in-memory history.
+
+Event ids are "<boot>-<seq>". After a restart, when the requested id has already left
+the history, or when the missed events wouldn't fit in the queue, the subscriber gets a
+"reset" event and should refetch its screen.
+
+With several uvicorn workers (see workers.py) each process has its own feed, and
+FeedRelay forwards every local event to the other processes as a UDP datagram on
+127.0.0.1. Processes find each other through "<pid>-<port>.peer" files in the shared
+directory, refreshed every FEED_RELAY_HEARTBEAT seconds. Event ids stay per process:
+a client that reconnects to another worker gets a "reset" and refetches.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import suppress
+from collections import deque
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+FEED_QUEUE_SIZE = int(os.environ.get("FEED_QUEUE_SIZE", "256"))
+FEED_HISTORY_SIZE = int(os.environ.get("FEED_HISTORY_SIZE", "5000"))
+FEED_KEEPALIVE = float(os.environ.get("FEED_KEEPALIVE", "15"))  # seconds between SSE comments on an idle stream
+FEED_RELAY_HEARTBEAT = float(os.environ.get("FEED_RELAY_HEARTBEAT", "2"))  # seconds
+
+# Put into a dropped subscriber's queue in place of the events it didn't keep up with
+DROPPED = object()
+
+
+@dataclass
+class Event:
+    seq: int
+    type: str
+    data: dict
+    item_id: int | None = None
+    location_ids: tuple = ()
+
+
+@dataclass(eq=False)
+class Subscription:
+    item_ids: frozenset = frozenset()
+    location_ids: frozenset = frozenset()
+    queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(FEED_QUEUE_SIZE))
+    dropped: bool = False
+
+    def matches(self, event: Event):
+        # Events without an item (e.g. "reset") go to everyone
+        if event.item_id is None:
+            return True
+        if self.item_ids and event.item_id not in self.item_ids:
+            return False
+        if self.location_ids and not self.location_ids.intersection(event.location_ids):
+            return False
+        return True
+
+
+class StockFeed:
+    def __init__(self, history_size: int = FEED_HISTORY_SIZE):
+        self.boot = format(int(time.time()), "x")
+        self.seq = 0
+        self.history: deque[Event] = deque(maxlen=history_size)
+        self.subscribers: set[Subscription] = set()
+        self.published_total = 0
+        self.dropped_total = 0
+        # Set by FeedRelay.start in multi-worker mode
+        self.relay: FeedRelay | None = None
+
+    def event_id(self, event: Event):
+        return f"{self.boot}-{event.seq}"
+
+    def publish(self, event_type: str, data: dict, item_id: int | None = None, location_ids=(), relay: bool = True):
+        self.seq += 1
+        event = Event(self.seq, event_type, data, item_id, tuple(loc for loc in location_ids if loc is not None))
+        self.history.append(event)
+        self.published_total += 1
+        for subscription in list(self.subscribers):
+            if subscription.matches(event):
+                self._deliver(subscription, event)
+        # Events received from another process are not sent on again
+        if relay and self.relay:
+            self.relay.send(event)
+
+    def _deliver(self, subscription: Subscription, event: Event):
+        try:
+            subscription.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow consumer: stop feeding it and let it resume from its last event id
+            self.subscribers.discard(subscription)
+            subscription.dropped = True
+            self.dropped_total += 1
+            while not subscription.queue.empty():
+                subscription.queue.get_nowait()
+            subscription.queue.put_nowait(DROPPED)
+
+    def subscribe(self, item_ids=(), location_ids=(), last_event_id: str | None = None):
+        subscription = Subscription(frozenset(item_ids), frozenset(location_ids))
+        if last_event_id:
+            missed = self._since(last_event_id)
+            if missed is not None:
+                missed = [event for event in missed if subscription.matches(event)]
+            if missed is None:
+                subscription.queue.put_nowait(Event(0, "reset", {"reason": "history"}))
+            elif len(missed) >= subscription.queue.maxsize > 0:
+                # A replay that fills the queue would drop the subscriber again at the next
+                # event, and it would reconnect into the same gap: refetching is the way out
+                subscription.queue.put_nowait(Event(0, "reset", {"reason": "backlog"}))
+            else:
+                for event in missed:
+                    subscription.queue.put_nowait(event)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def _since(self, last_event_id: str):
+        # Events after last_event_id, or None when they can't be replayed
+        boot, _, seq = last_event_id.partition("-")
+        if boot != self.boot or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if seq > self.seq:
+            return None
+        if self.history and seq < self.history[0].seq - 1:
+            return None
+        return [event for event in self.history if event.seq > seq]
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscribers.discard(subscription)
+
+    async def stream(self, subscription: Subscription):
+        """SSE-кадры для подписки; комментарий-keepalive, пока событий нет."""
+        yield "retry: 3000\n\n"
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), FEED_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is DROPPED:
+                    yield "event: dropped\ndata: {}\n\n"
+                    return
+                data = json.dumps(event.data, ensure_ascii=False, separators=(",", ":"))
+                if event.seq:
+                    yield f"id: {self.event_id(event)}\nevent: {event.type}\ndata: {data}\n\n"
+                else:
+                    yield f"event: {event.type}\ndata: {data}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        stats = {
+            "subscribers": len(self.subscribers),
+            "published_total": self.published_total,
+            "dropped_total": self.dropped_total,
+            "history": len(self.history),
+            "last_event_id": f"{self.boot}-{self.seq}",
+        }
+        if self.relay:
+            stats["relay"] = self.relay.stats()
+        return stats
+
+
+class FeedRelay(asyncio.DatagramProtocol):
+    """Пересылка событий ленты между процессами одной БД через UDP на localhost."""
+
+    def __init__(self, feed: StockFeed, directory: str, heartbeat: float = FEED_RELAY_HEARTBEAT):
+        self.feed = feed
+        self.directory = directory
+        self.heartbeat = heartbeat
+        self.peers: list[tuple[str, int]] = []
+        self.sent_total = 0
+        self.received_total = 0
+        self.transport: asyncio.DatagramTransport | None = None
+        self.peer_file: str | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=("127.0.0.1", 0))
+        port = self.transport.get_extra_info("sockname")[1]
+        self.peer_file = os.path.join(self.directory, f"{os.getpid()}-{port}.peer")
+        self._touch()
+        self.peers = self._scan()
+        self.feed.relay = self
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.feed.relay = None
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self.peer_file:
+            with suppress(OSError):
+                os.remove(self.peer_file)
+        if self.transport:
+            self.transport.close()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                self._touch()
+                self.peers = self._scan()
+            except OSError as e:
+                logger.warning(f"Ретранслятор ленты: не удалось обновить список процессов: {e}")
+
+    def _touch(self):
+        with open(self.peer_file, "ab"):
+            pass
+        os.utime(self.peer_file)
+
+    def _scan(self):
+        # A process that hasn't refreshed its file for a few heartbeats is gone
+        peers = []
+        stale_before = time.time() - 5 * self.heartbeat
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".peer") or entry.path == self.peer_file:
+                continue
+            _, _, port = entry.name[:-len(".peer")].partition("-")
+            if not port.isdigit():
+                continue
+            try:
+                if entry.stat().st_mtime < stale_before:
+                    os.remove(entry.path)
+                    continue
+            except OSError:
+                continue
+            peers.append(("127.0.0.1", int(port)))
+        return peers
+
+    def send(self, event: Event):
+        if not self.peers:
+            return
+        datagram = json.dumps(
+            [event.type, event.data, event.item_id, event.location_ids], ensure_ascii=False, separators=(",", ":"),
+        ).encode()
+        for peer in self.peers:
+            self.transport.sendto(datagram, peer)
+        self.sent_total += 1
+
+    def datagram_received(self, datagram, addr):
+        try:
+            event_type, data, item_id, location_ids = json.loads(datagram)
+        except ValueError:
+            return
+        self.received_total += 1
+        self.feed.publish(event_type, data, item_id, location_ids, relay=False)
+
+    def error_received(self, exc):
+        # E.g. ICMP port unreachable from a peer that just exited; its file goes stale
+        logger.debug(f"Ретранслятор ленты: {exc}")
+
+    def stats(self):
+        return {"peers": len(self.peers), "sent_total": self.sent_total, "received_total": self.received_total}
+
+
+stock_feed = StockFeed()
+
+
+def publish_stock_change(data: dict, item_id: int, location_ids=()):
+    stock_feed.publish("stock", data, item_id, location_ids)
+
+
+def publish_reset(reason: str):
+    # Bulk changes (import, rebuild) are announced once instead of item by item
+    stock_feed.publish("reset", {"reason": reason})
@@ -0,0 +1,207 @@
+"""
+Групповая фиксация операций.
+
+With GROUP_COMMIT=true, POST /api/operations does not open a transaction per request.
+The operation goes into a queue and the caller awaits its own result. A single writer
+task takes the first queued operation plus whatever arrives within
+GROUP_COMMIT_MAX_WAIT_MS, up to GROUP_COMMIT_MAX_OPS, and applies the group in one
+transaction. The group is applied set-based like POST /api/operations/batch: rows are
+loaded once for the whole group and an operation that fails validation writes nothing
+and gets its own error. If the group as a whole hits a database error, its SAVEPOINT is
+rolled back and the operations are replayed one by one, each in its own SAVEPOINT, so
+the failure stays with the operation that caused it. The SQLite write lock, the commit
+and the per-statement overhead are then paid once per group instead of once per scan,
+and writers no longer queue on busy_timeout.
+
+Latency stays bounded: an operation waits at most GROUP_COMMIT_MAX_WAIT_MS for the group
+to fill, plus the commit of the group in front of it. A full queue (GROUP_COMMIT_QUEUE_SIZE)
+makes callers wait for a free slot instead of growing without limit.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+import metrics
+from database import write_session
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+GROUP_COMMIT = os.environ.get("GROUP_COMMIT", "false").lower() in ("1", "true", "yes")
+GROUP_COMMIT_MAX_OPS = int(os.environ.get("GROUP_COMMIT_MAX_OPS", "100"))
+GROUP_COMMIT_MAX_WAIT_MS = float(os.environ.get("GROUP_COMMIT_MAX_WAIT_MS", "2"))
+GROUP_COMMIT_QUEUE_SIZE = int(os.environ.get("GROUP_COMMIT_QUEUE_SIZE", "1000"))
+
+GROUP_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Put into the queue by stop(): the writer commits what is queued before it and exits
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """
+    Единственный писатель операций в режиме групповой фиксации.
+
+    `apply_group(session, ops)` runs the group inside the shared transaction and returns
+    `(outcomes, after_commit)`, one result or exception per operation, see
+    requests.apply_operation_group. `apply(session, op)` does the same for a single
+    operation and is the fallback. The after_commit callbacks (outbox wakeup, cache
+    invalidation, stock feed) run only once the group is committed.
+    """
+
+    def __init__(
+        self,
+        apply_group,
+        apply,
+        max_ops: int = GROUP_COMMIT_MAX_OPS,
+        max_wait_ms: float = GROUP_COMMIT_MAX_WAIT_MS,
+        queue_size: int = GROUP_COMMIT_QUEUE_SIZE,
+    ):
+        self.apply_group = apply_group
+        self.apply = apply
+        self.max_ops = max_ops
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.group_sizes = metrics.Histogram(GROUP_SIZE_BUCKETS)
+        self.commit_seconds = metrics.Histogram(metrics.LATENCY_BUCKETS)
+        self.operations_total = 0
+        self.failed_operations = 0
+        self.failed_groups = 0
+        self.replayed_groups = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Callers that are already queued still get their results
+        if self._task:
+            await self.queue.put(_STOP)
+            await self._task
+            self._task = None
+
+    async def submit(self, op):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((op, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self.queue.get()
+            if entry is _STOP:
+                return
+            group = [entry]
+            stopping = False
+            deadline = loop.time() + self.max_wait
+            while len(group) < self.max_ops:
+                try:
+                    entry = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        entry = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if entry is _STOP:
+                    stopping = True
+                    break
+                group.append(entry)
+            await self.commit_group(group)
+            if stopping:
+                return
+
+    async def commit_group(self, group):
+        started = time.perf_counter()
+        ops = [op for op, _ in group]
+        try:
+            # write_session takes the SQLite write lock up front, so the savepoints below
+            # nest in a real transaction and releasing one doesn't commit
+            async with write_session() as session:
+                try:
+                    async with session.begin_nested():
+                        outcomes, after_commit = await self.apply_group(session, ops)
+                    callbacks = [after_commit]
+                except Exception as e:
+                    self.replayed_groups += 1
+                    logger.warning(f"Группа из {len(ops)} операций не применилась целиком ({e}), повтор по одной")
+                    outcomes, callbacks = await self.apply_each(session, ops)
+        except Exception as e:
+            # The commit itself failed: nothing in the group was written
+            self.failed_groups += 1
+            logger.error(f"Не удалось зафиксировать группу из {len(group)} операций: {e}")
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.group_sizes.observe(len(group))
+        self.commit_seconds.observe(time.perf_counter() - started)
+        self.operations_total += len(group)
+        for after_commit in callbacks:
+            after_commit()
+        for (_, future), outcome in zip(group, outcomes):
+            # The caller may have gone away (client disconnect); its operation is committed anyway
+            if future.done():
+                continue
+            if isinstance(outcome, BaseException):
+                self.failed_operations += 1
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+    async def apply_each(self, session, ops):
+        outcomes = []
+        callbacks = []
+        for op in ops:
+            try:
+                async with session.begin_nested():
+                    result, after_commit = await self.apply(session, op)
+            except Exception as e:
+                outcomes.append(e)
+            else:
+                outcomes.append(result)
+                callbacks.append(after_commit)
+        return outcomes, callbacks
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "groups_total": self.group_sizes.count,
+            "operations_total": self.operations_total,
+            "failed_operations": self.failed_operations,
+            "failed_groups": self.failed_groups,
+            "replayed_groups": self.replayed_groups,
+            "average_group_size": round(self.operations_total / self.group_sizes.count, 2) if self.group_sizes.count else 0,
+        }
+
+    def metric_lines(self):
+        labels = 'writer="operations"'
+        lines = [
+            "# TYPE group_commit_queued gauge",
+            f"group_commit_queued{{{labels}}} {self.queue.qsize()}",
+            "# TYPE group_commit_failed_groups_total counter",
+            f"group_commit_failed_groups_total{{{labels}}} {self.failed_groups}",
+            "# TYPE group_commit_failed_operations_total counter",
+            f"group_commit_failed_operations_total{{{labels}}} {self.failed_operations}",
+            "# TYPE group_commit_replayed_groups_total counter",
+            f"group_commit_replayed_groups_total{{{labels}}} {self.replayed_groups}",
+            "# HELP group_commit_group_size Operations committed per transaction.",
+            "# TYPE group_commit_group_size histogram",
+        ]
+        lines += self.group_sizes.render("group_commit_group_size", labels)
+        lines += [
+            "# HELP group_commit_seconds Time to apply and commit one group.",
+            "# TYPE group_commit_seconds histogram",
+        ]
+        lines += self.commit_seconds.render("group_commit_seconds", labels)
+        return lines
+
+
+# Set by main.py on startup when GROUP_COMMIT is on
+writer: GroupCommitWriter | None = None
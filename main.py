@@ -1,16 +1,29 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Depends
+import asyncio
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Header
 import logging
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse, Response
+import orjson
+from pydantic import BaseModel, Field
 from sqlalchemy import select, update, delete, func
-from models import init_db, User, UserRole # Ensure Item is imported if you need it here, but typically it's used in requests.py
+from models import User, UserRole # Ensure Item is imported if you need it here, but typically it's used in requests.py
 # Correctly aliasing requests.py functions as rq
 import requests as rq # Renamed the import to avoid confusion with the 'requests' library
 from sqlalchemy.ext.asyncio import AsyncSession
-from database import get_async_session
+from database import get_async_session, engine
+import outbox
+import feed
+import group_commit
+import workers
+from migrations import init_db
+import metrics
+from metrics import MetricsMiddleware
 import os
 from typing import Optional, List
+from datetime import date, datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from cache import Snapshot
 from dotenv import load_dotenv
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
@@ -37,6 +50,8 @@ class OperationData(BaseModel):
     type: str
     quantity: int = 1
     note: str = ""
+    from_location_id: Optional[int] = None # для частичного перемещения: откуда списать quantity
+    idempotency_key: Optional[str] = Field(None, max_length=64) # UUID операции на сканере, повтор с тем же ключом не применяется
 
 class LocationCreate(BaseModel):
     name: str
@@ -48,6 +63,11 @@ class LocationUpdate(BaseModel):
     code: Optional[str] = None
     description: Optional[str] = None
 
+class InventoryCountCreate(BaseModel):
+    location_id: int
+    user_tg_id: int
+    note: Optional[str] = None
+
 class SyncData(BaseModel):
     entity_type: str
     entity_id: int
@@ -59,13 +79,161 @@ class UserRegistration(BaseModel):
     role: UserRole
     admin_password: str | None = None
 
+# Период снимка остатков и архивации старых операций, секунды; 0 отключает
+LEDGER_COMPACT_INTERVAL = float(os.environ.get("LEDGER_COMPACT_INTERVAL", "86400"))
+
+async def compact_ledger_periodically():
+    while True:
+        await asyncio.sleep(LEDGER_COMPACT_INTERVAL)
+        try:
+            await rq.compact_ledger()
+        except Exception as e:
+            logger.error(f"Ошибка сжатия журнала операций: {e}")
+
+# Модели ответов. The list endpoints return rows built by requests.py as ORJSONResponse
+# directly, skipping per-row validation; for them the models only describe the schema.
+class ItemOut(BaseModel):
+    id: int
+    user_id: Optional[int]
+    barcode: str
+    name: str
+    sku: Optional[str]
+    quantity: int
+    location_id: int
+    description: Optional[str]
+    external_id: Optional[str]
+    status: str
+    updated_at: Optional[datetime]
+    last_operation_id: Optional[int]
+
+class OperationOut(BaseModel):
+    id: int
+    user_id: int
+    item_id: int
+    location_id: int
+    type: str
+    quantity: int
+    note: Optional[str]
+    from_location_id: Optional[int]
+    idempotency_key: Optional[str]
+    created_at: Optional[datetime]
+
+class ItemWithOperationOut(ItemOut):
+    last_operation: Optional[OperationOut] = None # только при include_last_operation=true
+
+class ItemPage(BaseModel):
+    items: List[ItemWithOperationOut]
+    next_cursor: Optional[str]
+
+class ItemList(BaseModel):
+    items: List[ItemOut]
+
+class ItemCreated(BaseModel):
+    status: str
+    item: ItemOut
+
+class OperationResult(BaseModel):
+    status: str # "ok" или "duplicate" для повтора с тем же ключом идемпотентности
+    operation_id: int
+    quantity: int
+
+class LocationOut(BaseModel):
+    id: int
+    name: str
+    code: str
+    description: Optional[str]
+
+class UserOut(BaseModel):
+    id: int
+    tg_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    last_login: Optional[datetime]
+    role: UserRole
+    is_active: bool
+    created_at: Optional[datetime]
+
+class LocationQuantity(BaseModel):
+    location_id: int
+    quantity: int
+
+class ItemQuantity(BaseModel):
+    item_id: int
+    quantity: int
+
+class ItemStock(BaseModel):
+    item_id: int
+    total: int
+    locations: List[LocationQuantity]
+
+class LocationStock(BaseModel):
+    location_id: int
+    total: int
+    items: List[ItemQuantity]
+
+class ORJSONResponse(JSONResponse):
+    """JSON через orjson: datetime, enum и вложенные dict сериализуются в C за один проход."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+# Background jobs that run in one process per database, see workers.py
+leader_jobs: dict[str, asyncio.Task] = {}
+
+async def start_leader_jobs():
+    sink = outbox.make_sink()
+    if sink:
+        outbox.worker = outbox.OutboxWorker(sink)
+        outbox.worker.start()
+    else:
+        logger.warning("SYNC_SINK не задан: события для 1С не записываются и не отправляются.")
+    if LEDGER_COMPACT_INTERVAL > 0:
+        leader_jobs["compaction"] = asyncio.create_task(compact_ledger_periodically())
+
+async def stop_leader_jobs():
+    compaction = leader_jobs.pop("compaction", None)
+    if compaction:
+        compaction.cancel()
+    if outbox.worker:
+        await outbox.worker.stop()
+        outbox.worker = None
+
 @asynccontextmanager
 async def lifespan(app_: FastAPI):
     await init_db()
+    relay = None
+    if workers.MULTI_WORKER:
+        # Other workers write to the same database: their invalidations and stock events
+        # reach this process through the shared directory
+        shared = workers.shared_dir()
+        rq.item_cache.share(os.path.join(shared, "item_cache.version"))
+        rq.reference_cache.share(os.path.join(shared, "reference_cache.version"))
+        relay = feed.FeedRelay(feed.stock_feed, shared)
+        await relay.start()
+        workers.lease = workers.LeaderLease(start_leader_jobs, stop_leader_jobs)
+        workers.lease.start()
+    else:
+        await start_leader_jobs()
+    if group_commit.GROUP_COMMIT:
+        group_commit.writer = group_commit.GroupCommitWriter(rq.apply_operation_group, rq.apply_operation)
+        group_commit.writer.start()
     print("Backend initialized")
     yield
+    if group_commit.writer:
+        # New operations go straight to the database while the queue drains
+        writer, group_commit.writer = group_commit.writer, None
+        await writer.stop()
+    if workers.lease:
+        lease, workers.lease = workers.lease, None
+        await lease.stop()
+    else:
+        await stop_leader_jobs()
+    if relay:
+        await relay.stop()
 
-app = FastAPI(title="DiplomSklad", lifespan=lifespan)
+app = FastAPI(title="DiplomSklad", lifespan=lifespan, default_response_class=ORJSONResponse)
+metrics.instrument_engine(engine)
 origins = [
     "https://diplomsklad-ee2d3.web.app", # Ваш фронтенд на Firebase Hosting
     "https://potential-broccoli-x5w54v7q7j9hvpwq-8000.app.github.dev", # Если фронтенд и бэкенд на одном домене, но разных портах
@@ -76,6 +244,7 @@ origins = [
     "https://potential-broccoli-x5w54v7q7j9hvpwq-8000.app.github.dev" # Добавьте ваш бэкенд URL
 ]
 
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -90,7 +259,7 @@ async def scan_item(data: ScanItem):
     return await rq.scan_or_create_item(data.barcode)
 
 # NEW ENDPOINT TO CREATE AN ITEM
-@app.post("/api/items")
+@app.post("/api/items", response_model=ItemCreated)
 async def create_item(item_data: ItemCreate):
     """
     Создает новый товар в базе данных.
@@ -107,24 +276,248 @@ async def create_item(item_data: ItemCreate):
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
 
-@app.get("/api/users/{tg_id}")
-async def get_user(tg_id: int, session: AsyncSession = Depends(get_async_session)):
-    user = await rq.fetch_user_by_tg_id(tg_id, session)
-    if not user:
+@app.get("/api/items/search", response_model=ItemList)
+async def search_items(q: str = Query(..., min_length=1, max_length=200), limit: int = Query(20, ge=1, le=100)):
+    """
+    Поиск товаров по названию, артикулу, штрихкоду и описанию (по началу слов).
+    """
+    return ORJSONResponse(await rq.search_items(q, limit))
+
+@app.post("/api/items/import")
+async def import_items(
+    request: Request,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    user_tg_id: Optional[int] = None,
+    chunk_size: int = Query(1000, ge=1, le=10000),
+):
+    """
+    Массовый импорт товаров из CSV/NDJSON в теле запроса, обрабатывается пачками по chunk_size строк.
+    Колонки: barcode, name, sku, quantity, location_id или location_code, description, external_id, user_tg_id.
+    """
+    return await rq.import_items(request.stream(), format, user_tg_id, chunk_size)
+
+def not_modified(request: Request, snapshot: Snapshot):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or snapshot.etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return snapshot.last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def cached_response(request: Request, snapshot: Snapshot):
+    """
+    Ответ из кэша справочников с ETag/Last-Modified; 304 без тела, если у клиента актуальная копия.
+    """
+    headers = {
+        "ETag": snapshot.etag,
+        "Last-Modified": format_datetime(snapshot.last_modified, usegmt=True),
+        # The client may keep the copy but has to revalidate it on every use
+        "Cache-Control": "private, no-cache",
+    }
+    if not_modified(request, snapshot):
+        return Response(status_code=304, headers=headers)
+    return Response(snapshot.body, media_type="application/json", headers=headers)
+
+@app.get("/api/users/{tg_id}", response_model=UserOut)
+async def get_user(tg_id: int, request: Request):
+    snapshot = await rq.fetch_user_snapshot(tg_id)
+    if not snapshot:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
-    return user
+    return cached_response(request, snapshot)
 
-@app.get("/api/users/{tg_id}/items")
-async def get_user_items(tg_id: int):
-    return await rq.get_items_by_user_tg(tg_id)
+@app.get("/api/users/{tg_id}/items", response_model=ItemPage)
+async def get_user_items(
+    tg_id: int,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    order_by: str = Query("id", pattern="^(id|updated_at)$"),
+    location_id: Optional[int] = None,
+    status: Optional[str] = None,
+    updated_since: Optional[datetime] = None,
+    include_last_operation: bool = False,
+):
+    """
+    Постраничный список товаров пользователя. Для следующей страницы передайте next_cursor.
+    """
+    return ORJSONResponse(await rq.get_items_by_user_tg(
+        tg_id,
+        limit=limit,
+        cursor=cursor,
+        order_by=order_by,
+        location_id=location_id,
+        status=status,
+        updated_since=updated_since,
+        include_last_operation=include_last_operation,
+    ))
 
-@app.post("/api/operations")
-async def create_operation(op: OperationData):
+@app.post("/api/operations", response_model=OperationResult)
+async def create_operation(op: OperationData, idempotency_key: Optional[str] = Header(None, max_length=64)):
+    """
+    Проводит операцию. Ключ идемпотентности можно передать в теле или в заголовке Idempotency-Key:
+    повторный запрос с тем же ключом вернет status "duplicate" и не изменит остатки.
+    """
+    if idempotency_key and not op.idempotency_key:
+        op.idempotency_key = idempotency_key
     return await rq.process_operation(op)
 
-@app.get("/api/locations")
-async def get_locations():
-    return await rq.fetch_all_locations()
+@app.post("/api/operations/batch")
+async def create_operations_batch(ops: List[OperationData]):
+    """
+    Применяет список операций в одной транзакции и возвращает результат по каждой записи.
+    """
+    return await rq.process_operations_batch(ops)
+
+@app.post("/api/devices/{device_id}/sync")
+async def sync_device(device_id: str, ops: List[OperationData]):
+    """
+    Принимает всю накопленную офлайн-очередь сканера. Операции с уже известными ключами пропускаются,
+    остальные применяются по порядку в одной транзакции; в ответе итоговые остатки по товарам.
+    """
+    return await rq.sync_device_operations(device_id, ops)
+
+@app.get("/api/stock/feed")
+async def stock_feed(
+    request: Request,
+    item_id: List[int] = Query([]),
+    location_id: List[int] = Query([]),
+    last_event_id: Optional[str] = None,
+):
+    """
+    Поток изменений остатков (Server-Sent Events). Фильтры item_id и location_id можно повторять.
+    После разрыва браузер сам передает Last-Event-ID и получает пропущенные события.
+    """
+    subscription = feed.stock_feed.subscribe(
+        item_id, location_id, request.headers.get("last-event-id") or last_event_id
+    )
+    return StreamingResponse(
+        feed.stock_feed.stream(subscription),
+        media_type="text/event-stream",
+        # X-Accel-Buffering: nginx must pass events through as they come
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/items/{item_id}/stock", response_model=ItemStock)
+async def get_item_stock(item_id: int):
+    return ORJSONResponse(await rq.fetch_item_stock(item_id))
+
+@app.get("/api/locations/{location_id}/stock", response_model=LocationStock)
+async def get_location_stock(location_id: int):
+    return ORJSONResponse(await rq.fetch_location_stock(location_id))
+
+@app.get("/api/stock/check")
+async def check_stock():
+    """
+    Сверяет таблицу остатков и количество товаров с журналом операций.
+    """
+    return await rq.check_stock_levels()
+
+@app.post("/api/stock/rebuild")
+async def rebuild_stock():
+    """
+    Пересобирает таблицу остатков по журналу операций и возвращает отчет о расхождениях.
+    Отказывает (409), если журнал не объясняет часть остатков и пересборка обнулила бы их.
+    """
+    return await rq.rebuild_stock_levels()
+
+@app.get("/api/stock/snapshots")
+async def get_stock_snapshots():
+    return await rq.fetch_stock_snapshots()
+
+@app.post("/api/stock/snapshots")
+async def create_stock_snapshot(before: Optional[datetime] = None):
+    """
+    Снимок остатков на последнюю операцию раньше before (по умолчанию LEDGER_RETENTION_DAYS назад).
+    """
+    return await rq.create_stock_snapshot(before)
+
+@app.post("/api/operations/archive")
+async def archive_operations():
+    """
+    Переносит операции, вошедшие в последний снимок остатков, в архив (operations_archive).
+    """
+    return await rq.archive_operations()
+
+@app.post("/api/inventory/counts")
+async def open_inventory_count(data: InventoryCountCreate):
+    """
+    Открывает инвентаризацию локации (не больше одной открытой на локацию).
+    """
+    return await rq.open_inventory_count(data)
+
+@app.get("/api/inventory/counts/{count_id}")
+async def get_inventory_count(count_id: int):
+    return await rq.fetch_inventory_count(count_id)
+
+@app.post("/api/inventory/counts/{count_id}/lines")
+async def add_inventory_count_lines(
+    count_id: int,
+    request: Request,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    replace: bool = False,
+    chunk_size: int = Query(1000, ge=1, le=10000),
+):
+    """
+    Подсчитанные товары из CSV/NDJSON в теле запроса: колонки barcode и quantity (по умолчанию 1).
+    Повторы штрихкода суммируются; replace=true заменяет ранее подсчитанное количество.
+    """
+    return await rq.add_inventory_count_lines(count_id, request.stream(), format, replace, chunk_size)
+
+@app.post("/api/inventory/counts/{count_id}/close")
+async def close_inventory_count(count_id: int, zero_uncounted: bool = True):
+    """
+    Закрывает инвентаризацию: проводит корректирующие операции и возвращает отчет о расхождениях.
+    zero_uncounted=false не обнуляет товары локации, которые не были подсчитаны.
+    """
+    return await rq.close_inventory_count(count_id, zero_uncounted)
+
+@app.get("/api/inventory/counts/{count_id}/report")
+async def get_inventory_report(count_id: int):
+    return await rq.fetch_inventory_report(count_id)
+
+@app.delete("/api/inventory/counts/{count_id}")
+async def cancel_inventory_count(count_id: int):
+    """
+    Отменяет открытую инвентаризацию без изменения остатков.
+    """
+    return await rq.cancel_inventory_count(count_id)
+
+@app.get("/api/reports/locations")
+async def report_locations(date_from: Optional[date] = None, date_to: Optional[date] = None):
+    """
+    Остатки по локациям и число операций по типам за период (по умолчанию REPORT_DEFAULT_DAYS дней).
+    """
+    return await rq.report_locations(date_from, date_to)
+
+@app.get("/api/reports/daily")
+async def report_daily(date_from: Optional[date] = None, date_to: Optional[date] = None, location_id: Optional[int] = None):
+    """
+    Операции и количества по дням и типам операций, по всем локациям или по одной.
+    """
+    return await rq.report_daily(date_from, date_to, location_id)
+
+@app.get("/api/reports/workers")
+async def report_workers(date_from: Optional[date] = None, date_to: Optional[date] = None, location_id: Optional[int] = None):
+    """
+    Операции и количества по сотрудникам и типам операций за период.
+    """
+    return await rq.report_workers(date_from, date_to, location_id)
+
+@app.post("/api/reports/rebuild")
+async def rebuild_reports():
+    """
+    Пересчитывает дневные итоги отчетов по журналу операций и архиву.
+    """
+    return await rq.rebuild_operation_rollups()
+
+@app.get("/api/locations", response_model=List[LocationOut])
+async def get_locations(request: Request):
+    return cached_response(request, await rq.fetch_locations_snapshot())
 
 @app.post("/api/locations")
 async def create_location(location_data: LocationCreate):
@@ -138,17 +531,63 @@ async def update_location(location_id: int, location_data: LocationUpdate):
 async def delete_location(location_id: int):
     return await rq.delete_existing_location(location_id)
 
-@app.get("/api/locations/{location_id}")
+@app.get("/api/locations/{location_id}", response_model=LocationOut)
 async def get_single_location(location_id: int, session: AsyncSession = Depends(get_async_session)):
     location = await rq.fetch_location_by_id(location_id, session)
     if not location:
         raise HTTPException(status_code=404, detail="Локация не найдена")
     return {"id": location.id, "name": location.name, "code": location.code, "description": location.description}
 
+EXPORT_MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+@app.get("/api/export/items")
+async def export_items(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    location_id: Optional[int] = None,
+):
+    """
+    Потоковая выгрузка товаров (CSV или NDJSON), фильтр по дате изменения и локации.
+    """
+    return StreamingResponse(
+        rq.export_items(format, date_from, date_to, location_id),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="items.{format}"'},
+    )
+
+@app.get("/api/export/operations")
+async def export_operations(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    location_id: Optional[int] = None,
+    include_archived: bool = False,
+):
+    """
+    Потоковая выгрузка журнала операций (CSV или NDJSON), фильтр по дате и локации.
+    include_archived=true добавляет операции из архива.
+    """
+    return StreamingResponse(
+        rq.export_operations(format, date_from, date_to, location_id, include_archived),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="operations.{format}"'},
+    )
+
 @app.post("/api/sync")
 async def sync_to_1c(data: SyncData):
+    """
+    Ставит сущность в очередь выгрузки в 1С. 503, если SYNC_SINK не задан.
+    """
     return await rq.log_sync(data)
 
+@app.get("/api/sync/status")
+async def sync_status():
+    """
+    Состояние очереди выгрузки в 1С: размер, отставание, результаты отправки.
+    """
+    return await outbox.outbox_metrics(outbox.worker)
+
 @app.post("/api/register")
 async def register_user(registration_data: UserRegistration):
     try:
@@ -160,6 +599,49 @@ async def register_user(registration_data: UserRegistration):
         logger.error(f"Неожиданная ошибка при регистрации пользователя: {e}")
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {e}")
 
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return {"items_by_barcode": rq.item_cache.stats(), "reference": rq.reference_cache.stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    cache = rq.item_cache.stats()
+    extra = [
+        "# TYPE item_cache_hits_total counter",
+        f"item_cache_hits_total {cache['hits']}",
+        "# TYPE item_cache_misses_total counter",
+        f"item_cache_misses_total {cache['misses']}",
+        "# TYPE item_cache_size gauge",
+        f"item_cache_size {cache['size']}",
+    ]
+    stock_feed = feed.stock_feed.stats()
+    extra += [
+        "# TYPE stock_feed_subscribers gauge",
+        f"stock_feed_subscribers {stock_feed['subscribers']}",
+        "# TYPE stock_feed_events_total counter",
+        f"stock_feed_events_total {stock_feed['published_total']}",
+        "# TYPE stock_feed_dropped_total counter",
+        f"stock_feed_dropped_total {stock_feed['dropped_total']}",
+    ]
+    if group_commit.writer is not None:
+        extra += group_commit.writer.metric_lines()
+    if workers.lease is not None:
+        # Each worker answers for itself; the label tells the scrapes apart
+        extra += [
+            "# TYPE worker_leader gauge",
+            f'worker_leader{{worker="{workers.WORKER_ID}"}} {int(workers.lease.is_leader)}',
+        ]
+    if outbox.worker is not None:
+        extra += [
+            "# TYPE outbox_sent_total counter",
+            f"outbox_sent_total {outbox.worker.sent_total}",
+            "# TYPE outbox_failed_batches_total counter",
+            f"outbox_failed_batches_total {outbox.worker.failed_batches}",
+            "# TYPE outbox_purged_total counter",
+            f"outbox_purged_total {outbox.worker.purged_total}",
+        ]
+    return PlainTextResponse(metrics.render(extra), media_type="text/plain; version=0.0.4")
+
 @app.post("/api/check_admin_password")
 async def check_admin_password(password_data: dict):
     password = password_data.get("password")
@@ -0,0 +1,205 @@
+import contextvars
+import logging
+import os
+import time
+from collections import Counter, defaultdict
+
+from sqlalchemy import event
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "1000"))  # 0 отключает лог медленных запросов
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("N_PLUS_ONE_THRESHOLD", "5"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def render(self, name: str, labels: str):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class RequestStats:
+    """Счетчики SQL одного HTTP-запроса, живут в contextvar на время запроса."""
+
+    __slots__ = ("statements", "db_time", "sql", "shapes")
+
+    def __init__(self, capture_sql: bool):
+        self.statements = 0
+        self.db_time = 0.0
+        self.sql = [] if capture_sql else None
+        self.shapes = Counter()
+
+
+_current: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar("request_stats", default=None)
+
+requests_total = Counter()  # (method, route, status) -> count
+request_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # (method, route) -> seconds
+request_statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))  # (method, route) -> statements
+request_db_seconds = Counter()  # (method, route) -> seconds spent in SQL
+n_plus_one_total = Counter()  # (method, route) -> requests with a repeated statement
+db_statements_total = 0
+db_seconds_total = 0.0
+
+
+def instrument_engine(engine):
+    """Подписывается на события движка: число запросов и время в БД по каждому HTTP-запросу."""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context: a statement that raises never reaches _after,
+        # and its start time goes away with the context instead of outliving it
+        context._query_start = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        global db_statements_total, db_seconds_total
+        elapsed = time.perf_counter() - context._query_start
+        db_statements_total += 1
+        db_seconds_total += elapsed
+        stats = _current.get()
+        if stats is None:
+            return
+        stats.statements += 1
+        stats.db_time += elapsed
+        stats.shapes[statement] += 1
+        if stats.sql is not None and len(stats.sql) < 100:
+            stats.sql.append(f"{elapsed * 1000:.1f}ms {statement[:500]}")
+
+
+def _route_label(scope):
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI middleware: гистограммы задержки по шаблону маршрута и SQL-статистика запроса."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(capture_sql=SLOW_REQUEST_MS > 0)
+        token = _current.set(stats)
+        status = 500
+        event_stream = False
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status, event_stream
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                event_stream = any(
+                    name == b"content-type" and value.startswith(b"text/event-stream")
+                    for name, value in message.get("headers", ())
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            self._record(scope, status, time.perf_counter() - started, stats, event_stream)
+
+    def _record(self, scope, status, elapsed, stats, event_stream=False):
+        key = (scope["method"], _route_label(scope))
+        requests_total[(*key, status)] += 1
+        request_latency[key].observe(elapsed)
+        request_statements[key].observe(stats.statements)
+        request_db_seconds[key] += stats.db_time
+
+        repeated = [(shape, n) for shape, n in stats.shapes.items() if n >= N_PLUS_ONE_THRESHOLD]
+        if repeated:
+            n_plus_one_total[key] += 1
+            shape, n = max(repeated, key=lambda r: r[1])
+            logger.warning(f"Возможный N+1 в {key[0]} {key[1]}: запрос выполнен {n} раз: {shape[:300]}")
+
+        # An SSE stream lasts as long as the client stays connected, that's not a slow request
+        if SLOW_REQUEST_MS > 0 and elapsed * 1000 >= SLOW_REQUEST_MS and not event_stream:
+            logger.warning(
+                f"Медленный запрос {key[0]} {scope['path']} ({key[1]}): {elapsed * 1000:.1f}ms, "
+                f"SQL: {stats.statements} шт., {stats.db_time * 1000:.1f}ms\n" + "\n".join(stats.sql or [])
+            )
+
+
+def _labels(method, route):
+    route = route.replace("\\", "\\\\").replace('"', '\\"')
+    return f'method="{method}",route="{route}"'
+
+
+def render(extra_lines=()):
+    """Все метрики в текстовом формате Prometheus."""
+    lines = [
+        "# HELP http_requests_total HTTP requests by route template and status.",
+        "# TYPE http_requests_total counter",
+    ]
+    for (method, route, status), count in sorted(requests_total.items()):
+        lines.append(f'http_requests_total{{{_labels(method, route)},status="{status}"}} {count}')
+
+    lines += [
+        "# HELP http_request_duration_seconds Request latency by route template.",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for key, histogram in sorted(request_latency.items()):
+        lines += histogram.render("http_request_duration_seconds", _labels(*key))
+
+    lines += [
+        "# HELP http_request_db_statements SQL statements executed per request.",
+        "# TYPE http_request_db_statements histogram",
+    ]
+    for key, histogram in sorted(request_statements.items()):
+        lines += histogram.render("http_request_db_statements", _labels(*key))
+
+    lines += [
+        "# HELP http_request_db_seconds_total Time spent in SQL by route template.",
+        "# TYPE http_request_db_seconds_total counter",
+    ]
+    for key, seconds in sorted(request_db_seconds.items()):
+        lines.append(f"http_request_db_seconds_total{{{_labels(*key)}}} {seconds}")
+
+    lines += [
+        "# HELP http_request_n_plus_one_total Requests that ran the same SQL statement repeatedly.",
+        "# TYPE http_request_n_plus_one_total counter",
+    ]
+    for key, count in sorted(n_plus_one_total.items()):
+        lines.append(f"http_request_n_plus_one_total{{{_labels(*key)}}} {count}")
+
+    lines += [
+        "# HELP db_statements_total SQL statements executed by the engine.",
+        "# TYPE db_statements_total counter",
+        f"db_statements_total {db_statements_total}",
+        "# HELP db_seconds_total Time spent executing SQL.",
+        "# TYPE db_seconds_total counter",
+        f"db_seconds_total {db_seconds_total}",
+    ]
+    lines += list(extra_lines)
+    return "\n".join(lines) + "\n"
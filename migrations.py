@@ -0,0 +1,509 @@
+"""
+Версионированные миграции схемы.
+
+Every step below runs once per database and is recorded in schema_version. On a
+database that is up to date, startup costs a single SELECT instead of a
+create_all pass over every table. Steps are idempotent (IF NOT EXISTS, checks
+against PRAGMA table_info) so databases created by the old create_all code, and
+two processes racing on the same upgrade, end up in the same state.
+
+Each step carries its own DDL, written out as it was released, and never reads the
+models: a table or index declared in models.py later must not change what an old step
+does on a database that is still behind. New schema changes go at the end of
+MIGRATIONS with the next version number, together with the matching model change;
+released steps are never edited. To upgrade before a rolling restart:
+
+    python migrations.py
+"""
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import models
+from database import begin_immediate, engine
+
+logger = logging.getLogger(__name__)
+
+# With AUTO_MIGRATE=false the app refuses to start on an outdated schema instead of upgrading it,
+# so only the deploy step (python migrations.py) takes the write lock for DDL
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "true").lower() in ("1", "true", "yes")
+
+SCHEMA_VERSION_DDL = """CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+)"""
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[..., Awaitable[None]]
+    # Optional steps may fail on SQLite builds without the feature; they are retried on the next start
+    optional: bool = False
+
+
+def _steps(*steps):
+    async def apply(conn):
+        for step in steps:
+            await step(conn)
+    return apply
+
+
+def _execute(*statements):
+    async def apply(conn):
+        for statement in statements:
+            await conn.exec_driver_sql(statement)
+    return apply
+
+
+def _add_column(table_name, column_name, ddl):
+    async def apply(conn):
+        columns = {row[1] for row in await conn.exec_driver_sql(f"PRAGMA table_info({table_name})")}
+        if column_name not in columns:
+            await conn.exec_driver_sql(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {ddl}")
+    return apply
+
+
+# Schema of each step as it was released. Steps don't read models.py: a later change to a
+# model goes into a new step, and a released step does the same thing on every database.
+
+# Tables of the original create_all code; later columns are added by their own steps
+INITIAL_SCHEMA_DDL = [
+    """CREATE TABLE IF NOT EXISTS users (
+        id INTEGER NOT NULL,
+        tg_id BIGINT NOT NULL,
+        username VARCHAR(50),
+        first_name VARCHAR(50),
+        last_name VARCHAR(50),
+        last_login DATETIME,
+        role VARCHAR(6) NOT NULL,
+        is_active BOOLEAN NOT NULL,
+        created_at DATETIME NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_tg_id ON users (tg_id)",
+    """CREATE TABLE IF NOT EXISTS locations (
+        id INTEGER NOT NULL,
+        name VARCHAR(100) NOT NULL,
+        code VARCHAR(50) NOT NULL,
+        description TEXT,
+        PRIMARY KEY (id),
+        UNIQUE (code)
+    )""",
+    """CREATE TABLE IF NOT EXISTS items (
+        id INTEGER NOT NULL,
+        user_id INTEGER,
+        barcode VARCHAR(100) NOT NULL,
+        name VARCHAR(255) NOT NULL,
+        sku VARCHAR(100),
+        quantity INTEGER NOT NULL,
+        location_id INTEGER NOT NULL,
+        description TEXT,
+        external_id VARCHAR(50),
+        status VARCHAR(50) NOT NULL,
+        updated_at DATETIME NOT NULL,
+        last_operation_id INTEGER,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES users (id),
+        FOREIGN KEY(location_id) REFERENCES locations (id),
+        FOREIGN KEY(last_operation_id) REFERENCES operations (id)
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_items_barcode ON items (barcode)",
+    """CREATE TABLE IF NOT EXISTS operations (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        location_id INTEGER NOT NULL,
+        type VARCHAR(9) NOT NULL,
+        quantity INTEGER NOT NULL,
+        note TEXT,
+        created_at DATETIME NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES users (id),
+        FOREIGN KEY(item_id) REFERENCES items (id),
+        FOREIGN KEY(location_id) REFERENCES locations (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS sync_logs (
+        id INTEGER NOT NULL,
+        entity_type VARCHAR(50) NOT NULL,
+        entity_id INTEGER NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        message TEXT,
+        synced_at DATETIME NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+]
+
+STOCK_LEVELS_DDL = [
+    """CREATE TABLE IF NOT EXISTS stock_levels (
+        item_id INTEGER NOT NULL,
+        location_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        updated_at DATETIME NOT NULL,
+        PRIMARY KEY (item_id, location_id),
+        FOREIGN KEY(item_id) REFERENCES items (id),
+        FOREIGN KEY(location_id) REFERENCES locations (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_stock_levels_location_item ON stock_levels (location_id, item_id)",
+]
+
+OUTBOX_DDL = [
+    """CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER NOT NULL,
+        entity_type VARCHAR(50) NOT NULL,
+        entity_id INTEGER NOT NULL,
+        event VARCHAR(50) NOT NULL,
+        payload TEXT NOT NULL,
+        idempotency_key VARCHAR(64) NOT NULL,
+        attempts INTEGER NOT NULL,
+        next_attempt_at DATETIME,
+        last_error TEXT,
+        created_at DATETIME NOT NULL,
+        sent_at DATETIME,
+        PRIMARY KEY (id),
+        UNIQUE (idempotency_key)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_outbox_pending ON outbox (sent_at, id)",
+]
+
+# Полнотекстовый индекс по товарам (SQLite FTS5, external content поверх items).
+# Triggers keep it in sync for every write path, including bulk executemany inserts;
+# the UPDATE trigger only fires for indexed columns, so stock changes don't touch it.
+ITEMS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+        name, sku, barcode, description,
+        content='items', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts(rowid, name, sku, barcode, description)
+        VALUES (new.id, new.name, new.sku, new.barcode, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, name, sku, barcode, description)
+        VALUES ('delete', old.id, old.name, old.sku, old.barcode, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name, sku, barcode, description ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, name, sku, barcode, description)
+        VALUES ('delete', old.id, old.name, old.sku, old.barcode, old.description);
+        INSERT INTO items_fts(rowid, name, sku, barcode, description)
+        VALUES (new.id, new.name, new.sku, new.barcode, new.description);
+    END""",
+]
+
+# Ranking used by "ORDER BY rank": BM25 weights for name, sku, barcode, description
+ITEMS_FTS_RANK = "bm25(10.0, 5.0, 5.0, 1.0)"
+
+# Indexes of step 6, as declared when it was released. Indexes declared later belong
+# to the step that adds their columns, so this list never changes.
+LEDGER_INDEXES_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_items_location ON items (location_id)",
+    "CREATE INDEX IF NOT EXISTS ix_items_updated_at ON items (updated_at)",
+    "CREATE INDEX IF NOT EXISTS ix_items_user ON items (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_items_user_updated ON items (user_id, updated_at)",
+    "CREATE INDEX IF NOT EXISTS ix_operations_created_at ON operations (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_operations_from_location ON operations (from_location_id)",
+    "CREATE INDEX IF NOT EXISTS ix_operations_item_created ON operations (item_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_operations_location_created ON operations (location_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_operations_user_created ON operations (user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_outbox_pending ON outbox (sent_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_levels_location_item ON stock_levels (location_id, item_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_items_barcode ON items (barcode)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_tg_id ON users (tg_id)",
+]
+
+IDEMPOTENCY_KEY_INDEX_DDL = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_operations_idempotency_key ON operations (idempotency_key)"
+)
+
+LEDGER_ARCHIVE_DDL = [
+    """CREATE TABLE IF NOT EXISTS stock_snapshots (
+        id INTEGER NOT NULL,
+        cutoff_operation_id INTEGER NOT NULL,
+        cutoff_at DATETIME NOT NULL,
+        rows INTEGER NOT NULL,
+        created_at DATETIME NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (cutoff_operation_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS stock_snapshot_rows (
+        snapshot_id INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        location_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (snapshot_id, item_id, location_id),
+        FOREIGN KEY(snapshot_id) REFERENCES stock_snapshots (id) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE IF NOT EXISTS operations_archive (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        location_id INTEGER NOT NULL,
+        from_location_id INTEGER,
+        idempotency_key VARCHAR(64),
+        type VARCHAR(9) NOT NULL,
+        quantity INTEGER NOT NULL,
+        note TEXT,
+        created_at DATETIME NOT NULL,
+        archived_at DATETIME NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_operations_archive_created_at ON operations_archive (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_operations_archive_item_created ON operations_archive (item_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_items_last_operation ON items (last_operation_id)",
+]
+
+# Дневные итоги операций. The trigger updates them in the transaction that inserts the
+# operation, whatever the write path (single, batch, group commit, bulk insert), so they
+# commit or roll back with it.
+OPERATION_ROLLUPS_DDL = [
+    """CREATE TABLE IF NOT EXISTS operation_daily_rollups (
+        day DATE NOT NULL,
+        location_id INTEGER NOT NULL,
+        type VARCHAR(9) NOT NULL,
+        user_id INTEGER NOT NULL,
+        operations INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (day, location_id, type, user_id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_operation_daily_rollups_location_day ON operation_daily_rollups (location_id, day)",
+    "CREATE INDEX IF NOT EXISTS ix_operation_daily_rollups_user_day ON operation_daily_rollups (user_id, day)",
+    """CREATE TRIGGER IF NOT EXISTS operations_daily_rollup AFTER INSERT ON operations BEGIN
+        INSERT INTO operation_daily_rollups (day, location_id, type, user_id, operations, quantity)
+        VALUES (date(new.created_at), new.location_id, new.type, new.user_id, 1, new.quantity)
+        ON CONFLICT (day, location_id, type, user_id) DO UPDATE
+        SET operations = operations + 1, quantity = quantity + excluded.quantity;
+    END""",
+]
+
+# Backfill of step 9, pinned; POST /api/reports/rebuild runs requests.OPERATION_ROLLUP_FILL
+OPERATION_ROLLUPS_FILL = """INSERT INTO operation_daily_rollups (day, location_id, type, user_id, operations, quantity)
+    SELECT date(created_at), location_id, type, user_id, count(*), sum(quantity)
+    FROM (
+        SELECT created_at, location_id, type, user_id, quantity FROM operations
+        UNION ALL
+        SELECT created_at, location_id, type, user_id, quantity FROM operations_archive
+    )
+    GROUP BY 1, 2, 3, 4"""
+
+INVENTORY_COUNTS_DDL = [
+    """CREATE TABLE IF NOT EXISTS inventory_counts (
+        id INTEGER NOT NULL,
+        location_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status VARCHAR(9) NOT NULL,
+        note TEXT,
+        scanned INTEGER NOT NULL,
+        adjusted INTEGER NOT NULL,
+        uncounted INTEGER NOT NULL,
+        created_at DATETIME NOT NULL,
+        closed_at DATETIME,
+        PRIMARY KEY (id),
+        FOREIGN KEY(location_id) REFERENCES locations (id),
+        FOREIGN KEY(user_id) REFERENCES users (id)
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_inventory_counts_open_location ON inventory_counts (location_id) WHERE status = 'open'",
+    """CREATE TABLE IF NOT EXISTS inventory_count_lines (
+        count_id INTEGER NOT NULL,
+        barcode VARCHAR(100) NOT NULL,
+        quantity INTEGER NOT NULL,
+        item_id INTEGER,
+        expected INTEGER,
+        PRIMARY KEY (count_id, barcode),
+        FOREIGN KEY(count_id) REFERENCES inventory_counts (id) ON DELETE CASCADE
+    )""",
+]
+
+WORKER_LEASES_DDL = [
+    """CREATE TABLE IF NOT EXISTS worker_leases (
+        name VARCHAR(50) NOT NULL,
+        owner VARCHAR(100) NOT NULL,
+        expires_at DATETIME NOT NULL,
+        PRIMARY KEY (name)
+    )""",
+]
+
+# A location can't be deleted while the archive or a snapshot still refers to it
+ARCHIVE_LOCATION_INDEXES_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_operations_archive_location ON operations_archive (location_id)",
+    "CREATE INDEX IF NOT EXISTS ix_operations_archive_from_location ON operations_archive (from_location_id)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_snapshot_rows_location ON stock_snapshot_rows (location_id)",
+]
+
+
+OPENING_BALANCE_NOTE = "Остаток на момент перехода на журнал операций"
+
+
+def _replay_operations(sync_conn):
+    # Per-location stock from the ledger, with the rules of requests._replay_ledger
+    levels = {}
+    rows = sync_conn.exec_driver_sql(
+        "SELECT item_id, location_id, from_location_id, type, quantity FROM operations ORDER BY id"
+    )
+    for item_id, location_id, from_location_id, type_, quantity in rows:
+        key = (item_id, location_id)
+        if type_ == "receive":
+            levels[key] = levels.get(key, 0) + quantity
+        elif type_ == "ship":
+            levels[key] = levels.get(key, 0) - quantity
+        elif type_ == "inventory":
+            levels[key] = quantity
+        elif from_location_id is not None:
+            source = (item_id, from_location_id)
+            levels[source] = levels.get(source, 0) - quantity
+            levels[key] = levels.get(key, 0) + quantity
+        else:
+            total = sum(levels.pop(other) for other in [k for k in levels if k[0] == item_id])
+            levels[key] = total
+    return levels
+
+
+async def _create_stock_levels(conn):
+    await _execute(*STOCK_LEVELS_DDL)(conn)
+    # Databases created before stock_levels existed: open with each item's current
+    # quantity at its current location
+    if await conn.scalar(text("SELECT item_id FROM stock_levels LIMIT 1")) is None:
+        await conn.exec_driver_sql(
+            "INSERT INTO stock_levels (item_id, location_id, quantity, updated_at) "
+            "SELECT id, location_id, quantity, CURRENT_TIMESTAMP FROM items WHERE quantity != 0"
+        )
+    # Stock that was there before the ledger (items created with a quantity, edits outside
+    # operations) has no operations behind it, and replaying the ledger would lose it. An
+    # opening inventory operation per such position makes the ledger agree with stock_levels.
+    levels = await conn.run_sync(_replay_operations)
+    stock = {
+        (item_id, location_id): quantity
+        for item_id, location_id, quantity in await conn.exec_driver_sql(
+            "SELECT item_id, location_id, quantity FROM stock_levels WHERE quantity != 0"
+        )
+    }
+    openings = [
+        (location_id, stock.get((item_id, location_id), 0), OPENING_BALANCE_NOTE, item_id)
+        for item_id, location_id in sorted(set(levels) | set(stock))
+        if levels.get((item_id, location_id), 0) != stock.get((item_id, location_id), 0)
+    ]
+    if openings:
+        # Recorded for the item's owner, or the first user for items without one
+        await conn.exec_driver_sql(
+            "INSERT INTO operations (user_id, item_id, location_id, type, quantity, note, created_at) "
+            "SELECT coalesce(items.user_id, (SELECT min(id) FROM users)), items.id, ?, 'inventory', ?, ?, CURRENT_TIMESTAMP "
+            "FROM items WHERE items.id = ? AND coalesce(items.user_id, (SELECT min(id) FROM users)) IS NOT NULL",
+            openings,
+        )
+        logger.info(f"Записаны начальные остатки для позиций: {len(openings)}")
+
+
+async def _create_search_index(conn):
+    exists = await conn.scalar(text("SELECT count(*) FROM sqlite_master WHERE name = 'items_fts'"))
+    await _execute(*ITEMS_FTS_DDL)(conn)
+    if not exists:
+        # Fill the index from the items already in the database
+        await conn.exec_driver_sql("INSERT INTO items_fts(items_fts) VALUES ('rebuild')")
+    # The rank setting is stored in the FTS config table, so it persists across restarts
+    await conn.exec_driver_sql(f"INSERT INTO items_fts(items_fts, rank) VALUES ('rank', '{ITEMS_FTS_RANK}')")
+
+
+async def _create_operation_rollups(conn):
+    # The step holds the write lock (see migrate), so no operation is written between
+    # creating the trigger and the backfill (counted twice or never)
+    await _execute(*OPERATION_ROLLUPS_DDL)(conn)
+    if await conn.scalar(text("SELECT day FROM operation_daily_rollups LIMIT 1")) is None:
+        await conn.exec_driver_sql(OPERATION_ROLLUPS_FILL)
+
+
+MIGRATIONS = [
+    Migration(1, "initial schema", _execute(*INITIAL_SCHEMA_DDL)),
+    Migration(2, "operations.from_location_id", _add_column("operations", "from_location_id", "INTEGER REFERENCES locations(id)")),
+    Migration(3, "stock_levels", _create_stock_levels),
+    Migration(4, "outbox", _execute(*OUTBOX_DDL)),
+    Migration(5, "items_fts", _create_search_index, optional=True),
+    Migration(6, "ledger and foreign key indexes", _execute(*LEDGER_INDEXES_DDL)),
+    Migration(7, "operations.idempotency_key", _steps(
+        _add_column("operations", "idempotency_key", "VARCHAR(64)"),
+        _execute(IDEMPOTENCY_KEY_INDEX_DDL),
+    )),
+    Migration(8, "stock snapshots and operations archive", _execute(*LEDGER_ARCHIVE_DDL)),
+    Migration(9, "daily operation rollups", _create_operation_rollups),
+    Migration(10, "inventory counts", _execute(*INVENTORY_COUNTS_DDL)),
+    Migration(11, "worker leases", _execute(*WORKER_LEASES_DDL)),
+    Migration(12, "location indexes on the archive and snapshots", _execute(*ARCHIVE_LOCATION_INDEXES_DDL)),
+]
+
+
+async def applied_versions(conn) -> set[int]:
+    await conn.exec_driver_sql(SCHEMA_VERSION_DDL)
+    return {row[0] for row in await conn.exec_driver_sql("SELECT version FROM schema_version")}
+
+
+async def pending_migrations() -> list[Migration]:
+    async with engine.begin() as conn:
+        applied = await applied_versions(conn)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+async def migrate() -> list[int]:
+    """Применяет недостающие миграции, возвращает номера примененных."""
+    done = []
+    for migration in await pending_migrations():
+        # One transaction per step: a failed optional step must not roll back the others
+        try:
+            async with engine.begin() as conn:
+                # Another process may have applied it since the check above. The write lock
+                # is taken before looking, so two processes starting together apply each
+                # step once: the second one waits, then finds it recorded. pysqlite would
+                # otherwise run the DDL outside any transaction.
+                await begin_immediate(conn)
+                if migration.version in await applied_versions(conn):
+                    continue
+                await migration.apply(conn)
+                await conn.exec_driver_sql(
+                    "INSERT OR IGNORE INTO schema_version (version, name) VALUES (?, ?)",
+                    (migration.version, migration.name),
+                )
+        except OperationalError as e:
+            if not migration.optional:
+                raise
+            logger.warning(f"Миграция {migration.version} ({migration.name}) пропущена: {e}")
+            continue
+        logger.info(f"Применена миграция {migration.version}: {migration.name}")
+        done.append(migration.version)
+    return done
+
+
+async def init_db():
+    pending = await pending_migrations()
+    if pending and not AUTO_MIGRATE:
+        # Optional steps that can't apply on this SQLite build don't block startup
+        required = [m.version for m in pending if not m.optional]
+        if required:
+            raise RuntimeError(f"Схема БД устарела, не применены миграции {required}: запустите python migrations.py")
+    elif pending:
+        await migrate()
+
+    async with engine.connect() as conn:
+        # Without FTS5 in the SQLite build search falls back to LIKE
+        models.search_enabled = bool(
+            await conn.scalar(text("SELECT count(*) FROM sqlite_master WHERE name = 'items_fts'"))
+        )
+    if not models.search_enabled:
+        logger.warning("FTS5 недоступен, поиск товаров будет работать через LIKE")
+
+
+async def _main():
+    applied = await migrate()
+    async with engine.connect() as conn:
+        current = max(await applied_versions(conn), default=0)
+    print(f"Применено миграций: {len(applied)}, версия схемы: {current}")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
@@ -1,14 +1,12 @@
 from sqlalchemy import (
-    ForeignKey, String, BigInteger, Integer, Text, Enum, DateTime, func
+    ForeignKey, String, BigInteger, Integer, Text, Enum, Date, DateTime, Index, func, text
 )
 from sqlalchemy.orm import Mapped, DeclarativeBase, mapped_column, relationship
-from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
-from datetime import datetime
+from sqlalchemy.sql import table, column
+from sqlalchemy.ext.asyncio import AsyncAttrs
+from datetime import date, datetime
 import enum
 
-engine = create_async_engine("sqlite+aiosqlite:///db.sqlite3", echo=True)
-async_session = async_sessionmaker(bind=engine, expire_on_commit=False)
-
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
@@ -31,6 +29,10 @@ class Operation(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     item_id: Mapped[int] = mapped_column(ForeignKey("items.id"))
     location_id: Mapped[int] = mapped_column(ForeignKey("locations.id"))
+    # Source location of a partial move; NULL for other types and for whole-item moves
+    from_location_id: Mapped[int | None] = mapped_column(ForeignKey("locations.id"), nullable=True)
+    # Client-generated key (UUID) of an operation queued on a scanner; retries with the same key are no-ops
+    idempotency_key: Mapped[str | None] = mapped_column(String(64), nullable=True)
     type: Mapped[OperationType] = mapped_column(Enum(OperationType))
     quantity: Mapped[int] = mapped_column(default=1)
     note: Mapped[str | None] = mapped_column(Text, nullable=True)
@@ -38,7 +40,17 @@ class Operation(Base):
 
     user: Mapped["User"] = relationship(back_populates="operations")
     item: Mapped["Item"] = relationship(back_populates="operations", foreign_keys=[item_id])
-    location: Mapped["Location"] = relationship(back_populates="operations")
+    location: Mapped["Location"] = relationship(back_populates="operations", foreign_keys=[location_id])
+
+    __table_args__ = (
+        # History of an item / a location / a worker, newest first or by date range
+        Index("ix_operations_item_created", "item_id", "created_at"),
+        Index("ix_operations_location_created", "location_id", "created_at"),
+        Index("ix_operations_user_created", "user_id", "created_at"),
+        Index("ix_operations_from_location", "from_location_id"),
+        Index("ix_operations_created_at", "created_at"),
+        Index("ux_operations_idempotency_key", "idempotency_key", unique=True),
+    )
 
 class User(Base):
     __tablename__ = "users"
@@ -62,7 +74,7 @@ class Location(Base):
     code: Mapped[str] = mapped_column(String(50), unique=True)
     description: Mapped[str | None] = mapped_column(Text, nullable=True)
     items: Mapped[list["Item"]] = relationship(back_populates="location")
-    operations: Mapped[list["Operation"]] = relationship(back_populates="location")
+    operations: Mapped[list["Operation"]] = relationship(back_populates="location", foreign_keys=[Operation.__table__.c.location_id])
 
 
 class Item(Base):
@@ -85,6 +97,161 @@ class Item(Base):
     operations: Mapped[list["Operation"]] = relationship(back_populates="item", foreign_keys=[Operation.__table__.c.item_id])
     last_operation: Mapped["Operation | None"] = relationship(foreign_keys=[last_operation_id], lazy="joined")
 
+    __table_args__ = (
+        # Per-user listing: keyset by id (rowid is implied) and by (updated_at, id)
+        Index("ix_items_user", "user_id"),
+        Index("ix_items_user_updated", "user_id", "updated_at"),
+        Index("ix_items_location", "location_id"),
+        Index("ix_items_updated_at", "updated_at"),
+        # Archiving keeps operations that are still some item's last operation
+        Index("ix_items_last_operation", "last_operation_id"),
+    )
+
+
+class StockLevel(Base):
+    """Остаток товара в конкретной локации. Сумма по локациям равна Item.quantity."""
+    __tablename__ = "stock_levels"
+    item_id: Mapped[int] = mapped_column(ForeignKey("items.id"), primary_key=True)
+    location_id: Mapped[int] = mapped_column(ForeignKey("locations.id"), primary_key=True)
+    quantity: Mapped[int] = mapped_column(default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_stock_levels_location_item", "location_id", "item_id"),
+    )
+
+
+class StockSnapshot(Base):
+    """Остатки на момент cutoff_operation_id: сверка и пересборка проигрывают журнал только после него."""
+    __tablename__ = "stock_snapshots"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # Operations with id <= cutoff_operation_id are included
+    cutoff_operation_id: Mapped[int] = mapped_column(Integer, unique=True)
+    cutoff_at: Mapped[datetime] = mapped_column(DateTime)
+    rows: Mapped[int] = mapped_column(default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
+
+
+class StockSnapshotRow(Base):
+    __tablename__ = "stock_snapshot_rows"
+    snapshot_id: Mapped[int] = mapped_column(ForeignKey("stock_snapshots.id", ondelete="CASCADE"), primary_key=True)
+    item_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    location_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    quantity: Mapped[int] = mapped_column(default=0)
+
+    __table_args__ = (
+        Index("ix_stock_snapshot_rows_location", "location_id"),
+    )
+
+
+class ArchivedOperation(Base):
+    """Операции старше последнего снимка остатков, перенесенные из operations."""
+    __tablename__ = "operations_archive"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    user_id: Mapped[int] = mapped_column(Integer)
+    item_id: Mapped[int] = mapped_column(Integer)
+    location_id: Mapped[int] = mapped_column(Integer)
+    from_location_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    idempotency_key: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    type: Mapped[OperationType] = mapped_column(Enum(OperationType))
+    quantity: Mapped[int] = mapped_column(default=1)
+    note: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime)
+    archived_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
+
+    __table_args__ = (
+        Index("ix_operations_archive_item_created", "item_id", "created_at"),
+        Index("ix_operations_archive_created_at", "created_at"),
+        Index("ix_operations_archive_location", "location_id"),
+        Index("ix_operations_archive_from_location", "from_location_id"),
+    )
+
+
+class OperationDailyRollup(Base):
+    """Итоги операций за день: дата × локация × тип × сотрудник. Ведется триггером, см. migrations.OPERATION_ROLLUPS_DDL."""
+    __tablename__ = "operation_daily_rollups"
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    # Destination location of the operation (operations.location_id), user is users.id
+    location_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    type: Mapped[OperationType] = mapped_column(Enum(OperationType), primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    operations: Mapped[int] = mapped_column(default=0)
+    # Sum of operations.quantity; for inventory that is the sum of counted quantities
+    quantity: Mapped[int] = mapped_column(default=0)
+
+    __table_args__ = (
+        Index("ix_operation_daily_rollups_location_day", "location_id", "day"),
+        Index("ix_operation_daily_rollups_user_day", "user_id", "day"),
+    )
+
+
+class InventoryCountStatus(str, enum.Enum):
+    open = "open"
+    closed = "closed"
+    cancelled = "cancelled"
+
+
+class InventoryCount(Base):
+    """Инвентаризация локации: подсчитанное копится в inventory_count_lines и сводится с остатками при закрытии."""
+    __tablename__ = "inventory_counts"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    location_id: Mapped[int] = mapped_column(ForeignKey("locations.id"))
+    # Who opened the count; the adjusting operations are written on their behalf
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    status: Mapped[InventoryCountStatus] = mapped_column(Enum(InventoryCountStatus), default=InventoryCountStatus.open)
+    note: Mapped[str | None] = mapped_column(Text, nullable=True)
+    # Records received, before aggregation by barcode
+    scanned: Mapped[int] = mapped_column(default=0)
+    # Filled on close: adjusting operations written, stocked items that were not counted
+    adjusted: Mapped[int] = mapped_column(default=0)
+    uncounted: Mapped[int] = mapped_column(default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
+    closed_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # At most one open count per location
+        Index("ux_inventory_counts_open_location", "location_id", unique=True, sqlite_where=text("status = 'open'")),
+    )
+
+
+class InventoryCountLine(Base):
+    """Подсчитанное количество по штрихкоду; повторные сканы складываются в одну строку."""
+    __tablename__ = "inventory_count_lines"
+    count_id: Mapped[int] = mapped_column(ForeignKey("inventory_counts.id", ondelete="CASCADE"), primary_key=True)
+    barcode: Mapped[str] = mapped_column(String(100), primary_key=True)
+    quantity: Mapped[int] = mapped_column(default=0)
+    # Resolved on close: the item (NULL for an unknown barcode) and its stock at the location then
+    item_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    expected: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+
+class OutboxEvent(Base):
+    """Событие для выгрузки в 1С, пишется в той же транзакции, что и изменение данных."""
+    __tablename__ = "outbox"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    entity_type: Mapped[str] = mapped_column(String(50))
+    entity_id: Mapped[int]
+    event: Mapped[str] = mapped_column(String(50))
+    payload: Mapped[str] = mapped_column(Text)
+    idempotency_key: Mapped[str] = mapped_column(String(64), unique=True)
+    attempts: Mapped[int] = mapped_column(default=0)
+    next_attempt_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
+    sent_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_outbox_pending", "sent_at", "id"),
+    )
+
+
+class WorkerLease(Base):
+    """Аренда роли процесса (например, ведущего для фоновых задач), см. workers.py."""
+    __tablename__ = "worker_leases"
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    owner: Mapped[str] = mapped_column(String(100))
+    expires_at: Mapped[datetime] = mapped_column(DateTime)
+
 
 class SyncLog(Base):
     __tablename__ = "sync_logs"
@@ -96,6 +263,9 @@ class SyncLog(Base):
     synced_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
 
 
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+# Полнотекстовый индекс по товарам (SQLite FTS5, external content поверх items).
+# Created with its triggers by migrations.ITEMS_FTS_DDL.
+items_fts = table("items_fts", column("rowid"))
+
+# Set by migrations.init_db; without FTS5 in the SQLite build search falls back to LIKE
+search_enabled = False
@@ -0,0 +1,277 @@
+import asyncio
+import json
+import logging
+import os
+import urllib.request
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, select, update, func, or_
+from dotenv import load_dotenv
+
+from database import async_session, write_session
+from models import OutboxEvent, SyncLog
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+SYNC_SINK = os.environ.get("SYNC_SINK", "")  # "file:<path>", "http(s)://..." or empty to keep events queued
+SYNC_BATCH_SIZE = int(os.environ.get("SYNC_BATCH_SIZE", "100"))
+SYNC_POLL_INTERVAL = float(os.environ.get("SYNC_POLL_INTERVAL", "2"))
+SYNC_BACKOFF_BASE = float(os.environ.get("SYNC_BACKOFF_BASE", "1"))
+SYNC_BACKOFF_MAX = float(os.environ.get("SYNC_BACKOFF_MAX", "300"))
+SYNC_HTTP_TIMEOUT = float(os.environ.get("SYNC_HTTP_TIMEOUT", "10"))
+# Delivered events are kept this long for troubleshooting, then deleted by the worker
+SYNC_RETENTION_DAYS = float(os.environ.get("SYNC_RETENTION_DAYS", "7"))
+SYNC_PURGE_INTERVAL = float(os.environ.get("SYNC_PURGE_INTERVAL", "3600"))  # seconds
+SYNC_PURGE_BATCH = int(os.environ.get("SYNC_PURGE_BATCH", "5000"))
+
+# Without a sink nothing would ever deliver the events, so callers don't write them at all
+ENABLED = bool(SYNC_SINK)
+
+
+def utcnow():
+    # Naive UTC, the same convention as SQLite's CURRENT_TIMESTAMP used for created_at
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def outbox_event(entity_type: str, entity_id: int, event: str, payload: dict):
+    """Row for `insert(OutboxEvent)`; callers add it in the transaction that made the change."""
+    return {
+        "entity_type": entity_type,
+        "entity_id": entity_id,
+        "event": event,
+        "payload": json.dumps(payload, ensure_ascii=False, default=str),
+        "idempotency_key": uuid.uuid4().hex,
+    }
+
+
+class FileSink:
+    """Дописывает пачки в NDJSON-файл. Заглушка 1С для локальной разработки и тестов."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _write(self, lines):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    async def send(self, batch_key: str, events: list[dict]):
+        lines = [json.dumps({"batch": batch_key, **event}, ensure_ascii=False) + "\n" for event in events]
+        await asyncio.to_thread(self._write, lines)
+
+
+class HttpSink:
+    """POST пачки событий в JSON. Получатель дедуплицирует по Idempotency-Key и event.idempotency_key."""
+
+    def __init__(self, url: str, timeout: float = SYNC_HTTP_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def _post(self, batch_key: str, body: bytes):
+        request = urllib.request.Request(
+            self.url,
+            data=body,
+            method="POST",
+            headers={"Content-Type": "application/json", "Idempotency-Key": batch_key},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if response.status >= 300:
+                raise RuntimeError(f"HTTP {response.status}")
+
+    async def send(self, batch_key: str, events: list[dict]):
+        body = json.dumps({"batch": batch_key, "events": events}, ensure_ascii=False).encode()
+        await asyncio.to_thread(self._post, batch_key, body)
+
+
+def make_sink(spec: str = SYNC_SINK):
+    if not spec:
+        return None
+    if spec.startswith("file:"):
+        return FileSink(spec[len("file:"):])
+    if spec.startswith(("http://", "https://")):
+        return HttpSink(spec)
+    raise ValueError(f"Неизвестный SYNC_SINK: {spec}")
+
+
+class OutboxWorker:
+    """
+    Фоновая задача: забирает неотправленные события пачками и передает их в sink.
+
+    A failed batch is retried with exponential backoff per event. Every event carries
+    its idempotency key, so a batch that was delivered but not acknowledged can be
+    resent safely. Each batch outcome is written to SyncLog. Every SYNC_PURGE_INTERVAL
+    the worker deletes events delivered more than SYNC_RETENTION_DAYS ago.
+    """
+
+    def __init__(self, sink, batch_size: int = SYNC_BATCH_SIZE, poll_interval: float = SYNC_POLL_INTERVAL):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.sent_total = 0
+        self.purged_total = 0
+        self.failed_batches = 0
+        self.last_success_at: datetime | None = None
+        self.last_error: str | None = None
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._next_purge = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        # Called after a commit that wrote outbox rows, so they go out without waiting for the poll
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                sent = await self.drain_once()
+            except Exception as e:
+                logger.error(f"Ошибка outbox-воркера: {e}")
+                sent = 0
+            loop = asyncio.get_running_loop()
+            if loop.time() >= self._next_purge:
+                self._next_purge = loop.time() + SYNC_PURGE_INTERVAL
+                try:
+                    self.purged_total += await purge_sent_events()
+                except Exception as e:
+                    logger.error(f"Ошибка очистки outbox: {e}")
+            if sent < self.batch_size:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def drain_once(self) -> int:
+        now = utcnow()
+        async with async_session() as session:
+            rows = (await session.scalars(
+                select(OutboxEvent)
+                .where(
+                    OutboxEvent.sent_at.is_(None),
+                    or_(OutboxEvent.next_attempt_at.is_(None), OutboxEvent.next_attempt_at <= now),
+                )
+                .order_by(OutboxEvent.id)
+                .limit(self.batch_size)
+            )).all()
+        if not rows:
+            return 0
+
+        ids = [r.id for r in rows]
+        batch_key = f"{ids[0]}-{ids[-1]}-{len(ids)}"
+        events = [
+            {
+                "id": r.id,
+                "idempotency_key": r.idempotency_key,
+                "entity_type": r.entity_type,
+                "entity_id": r.entity_id,
+                "event": r.event,
+                "payload": json.loads(r.payload),
+                "created_at": r.created_at.isoformat() if r.created_at else None,
+            }
+            for r in rows
+        ]
+
+        try:
+            await self.sink.send(batch_key, events)
+        except Exception as e:
+            self.failed_batches += 1
+            self.last_error = str(e)
+            logger.warning(f"Не удалось отправить пачку {batch_key} в 1С: {e}")
+            async with write_session() as session:
+                for r in rows:
+                    delay = min(SYNC_BACKOFF_BASE * 2 ** r.attempts, SYNC_BACKOFF_MAX)
+                    await session.execute(
+                        update(OutboxEvent)
+                        .where(OutboxEvent.id == r.id)
+                        .values(
+                            attempts=OutboxEvent.attempts + 1,
+                            next_attempt_at=now + timedelta(seconds=delay),
+                            last_error=str(e),
+                        )
+                    )
+                session.add(SyncLog(
+                    entity_type="outbox_batch", entity_id=ids[-1], status="error",
+                    message=f"{batch_key}: {e}",
+                ))
+            return 0
+
+        async with write_session() as session:
+            await session.execute(
+                update(OutboxEvent)
+                .where(OutboxEvent.id.in_(ids))
+                .values(sent_at=utcnow(), attempts=OutboxEvent.attempts + 1, last_error=None)
+            )
+            session.add(SyncLog(
+                entity_type="outbox_batch", entity_id=ids[-1], status="success",
+                message=f"{batch_key}: отправлено событий {len(ids)}",
+            ))
+        self.sent_total += len(ids)
+        self.last_success_at = utcnow()
+        return len(ids)
+
+
+async def purge_sent_events(before: datetime | None = None, batch_size: int = SYNC_PURGE_BATCH) -> int:
+    """Удаляет события, доставленные раньше `before`; пачками, чтобы не держать блокировку записи."""
+    if before is None:
+        before = utcnow() - timedelta(days=SYNC_RETENTION_DAYS)
+    purged = 0
+    while True:
+        async with write_session() as session:
+            result = await session.execute(
+                delete(OutboxEvent)
+                .where(OutboxEvent.id.in_(
+                    select(OutboxEvent.id).where(OutboxEvent.sent_at < before).limit(batch_size)
+                ))
+                .execution_options(synchronize_session=False)
+            )
+        purged += result.rowcount
+        if result.rowcount < batch_size:
+            break
+        # Yield to the requests waiting for the write lock
+        await asyncio.sleep(0)
+    if purged:
+        logger.info(f"Удалено доставленных событий outbox: {purged}")
+    return purged
+
+
+async def outbox_metrics(worker: OutboxWorker | None = None):
+    async with async_session() as session:
+        pending, oldest = (await session.execute(
+            select(func.count(OutboxEvent.id), func.min(OutboxEvent.created_at)).where(OutboxEvent.sent_at.is_(None))
+        )).one()
+        retrying = await session.scalar(
+            select(func.count(OutboxEvent.id)).where(OutboxEvent.sent_at.is_(None), OutboxEvent.attempts > 0)
+        )
+    return {
+        "running": worker is not None,
+        "pending": pending,
+        "retrying": retrying,
+        "lag_seconds": round((utcnow() - oldest).total_seconds(), 3) if oldest else 0.0,
+        "sent_total": worker.sent_total if worker else 0,
+        "purged_total": worker.purged_total if worker else 0,
+        "failed_batches": worker.failed_batches if worker else 0,
+        "last_success_at": worker.last_success_at.isoformat() if worker and worker.last_success_at else None,
+        "last_error": worker.last_error if worker else None,
+    }
+
+
+# Created in main.lifespan when SYNC_SINK is configured
+worker: OutboxWorker | None = None
+
+
+def notify():
+    if worker is not None:
+        worker.wake()
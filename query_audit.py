@@ -0,0 +1,228 @@
+"""
+Проверка планов запросов.
+
+Runs every data-access function of requests.py (and the outbox worker) against a
+scratch SQLite database, captures each SQL statement they execute and checks its
+EXPLAIN QUERY PLAN. A statement that scans a whole table (or a whole index) fails
+the audit unless the function is expected to read everything:
+
+    python query_audit.py           # exit code 1 when a query degrades to a scan
+    python query_audit.py --verbose # print every plan
+"""
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime
+from types import SimpleNamespace
+
+# Functions that read whole tables on purpose
+FULL_SCAN_ALLOWED = {
+    "fetch_all_locations": "справочник локаций выдается целиком",
+    "check_stock_levels": "сверка проигрывает весь журнал",
+    "rebuild_stock_levels": "пересборка проигрывает весь журнал",
+    "export_items": "полная выгрузка",
+    "export_operations": "полная выгрузка",
+    "fetch_stock_snapshots": "список снимков короткий (SNAPSHOT_KEEP)",
+    "report_locations": "остатки суммируются по всем локациям",
+    "rebuild_operation_rollups": "пересчет итогов по всему журналу",
+}
+
+# "SCAN items", "SCAN items USING INDEX ...", "SCAN items USING COVERING INDEX ..."; subqueries,
+# materialized subquery results (anon_N), constant rows and FTS5 virtual table lookups are not table scans
+SCAN_RE = re.compile(r"^SCAN (?!\(|CONSTANT ROW|anon_\d)(\w+)\b(?! VIRTUAL TABLE)")
+
+# "ORDER BY <indexed> LIMIT n" without a WHERE walks the index and stops after n rows
+INDEX_SCAN_RE = re.compile(r"^SCAN \w+ USING (COVERING )?INDEX ")
+
+_current_call: contextvars.ContextVar[str | None] = contextvars.ContextVar("audit_call", default=None)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="EXPLAIN QUERY PLAN для запросов requests.py")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args()
+
+
+async def exercise(rq, outbox):
+    """Вызывает функции requests.py так, чтобы выполнились все их ветки с запросами."""
+    captured_calls = []
+
+    async def call(name, coro):
+        token = _current_call.set(name)
+        try:
+            result = await coro
+        except rq.HTTPException:
+            result = None
+        finally:
+            _current_call.reset(token)
+        captured_calls.append(name)
+        return result
+
+    async def consume(name, generator):
+        token = _current_call.set(name)
+        try:
+            async for _ in generator:
+                pass
+        finally:
+            _current_call.reset(token)
+
+    async def body(data: bytes):
+        yield data
+
+    ns = SimpleNamespace
+    await call("register_new_user", rq.register_new_user(ns(tg_id=1, username="audit", role=rq.UserRole.worker, admin_password=None)))
+    await call("create_new_location", rq.create_new_location(ns(name="A", code="A", description=None)))
+    await call("create_new_location", rq.create_new_location(ns(name="B", code="B", description=None)))
+    await call("create_new_location", rq.create_new_location(ns(name="C", code="C", description=None)))
+    await call("update_existing_location", rq.update_existing_location(2, ns(name="B2", code="B2", description="d")))
+    await call("create_item", rq.create_item(ns(barcode="100", name="Молоток", sku="HM", location_id=1, quantity=10, note=None, user_tg_id=1)))
+    await call("create_item", rq.create_item(ns(barcode="200", name="Гвозди", sku="NL", location_id=1, quantity=0, note=None, user_tg_id=1)))
+    await call("scan_or_create_item", rq.scan_or_create_item("100"))
+    await call("scan_or_create_item", rq.scan_or_create_item("missing"))
+    await call("search_items", rq.search_items("молот"))
+
+    def op(type_, **extra):
+        values = {"user_id": 1, "item_id": 1, "location_id": 1, "type": type_, "quantity": 1, "note": "", "from_location_id": None, "idempotency_key": None}
+        values.update(extra)
+        return ns(**values)
+
+    for operation in (
+        op("receive", quantity=5), op("ship"), op("ship", quantity=10_000), op("inventory", quantity=20),
+        op("move", location_id=2, from_location_id=1), op("move", location_id=2), op("ship", item_id=999),
+    ):
+        await call("process_operation", rq.process_operation(operation))
+    await call("process_operations_batch", rq.process_operations_batch([op("receive"), op("move", location_id=1), op("ship", item_id=999)]))
+    await call("process_operation", rq.process_operation(op("receive", idempotency_key="audit-1")))
+    await call("process_operation", rq.process_operation(op("receive", idempotency_key="audit-1")))
+    await call("sync_device_operations", rq.sync_device_operations("audit", [op("receive", idempotency_key="audit-1"), op("receive", idempotency_key="audit-2")]))
+    async with rq.async_session() as session:
+        async with session.begin():
+            await call("apply_operation_group", rq.apply_operation_group(session, [op("receive"), op("ship", item_id=999), op("receive", idempotency_key="audit-2")]))
+
+    await call("get_items_by_user_tg", rq.get_items_by_user_tg(1, limit=1))
+    page = await call("get_items_by_user_tg", rq.get_items_by_user_tg(1, limit=1, order_by="updated_at", include_last_operation=True))
+    await call("get_items_by_user_tg", rq.get_items_by_user_tg(1, limit=1, cursor=rq._encode_cursor(1)))
+    if page and page["next_cursor"]:
+        await call("get_items_by_user_tg", rq.get_items_by_user_tg(1, limit=1, order_by="updated_at", cursor=page["next_cursor"]))
+    await call("fetch_item_stock", rq.fetch_item_stock(1))
+    await call("fetch_location_stock", rq.fetch_location_stock(1))
+    await call("delete_existing_location", rq.delete_existing_location(1))
+    await call("delete_existing_location", rq.delete_existing_location(3))
+
+    async with rq.async_session() as session:
+        await call("fetch_user_by_tg_id", rq.fetch_user_by_tg_id(1, session))
+        await call("fetch_location_by_id", rq.fetch_location_by_id(2, session))
+    await call("fetch_all_locations", rq.fetch_all_locations())
+    await call("import_items", rq.import_items(body(b"barcode,name,quantity,location_code,user_tg_id\n300,x,2,B2,1\n"), "csv", None, 100))
+    count = await call("open_inventory_count", rq.open_inventory_count(ns(location_id=2, user_tg_id=1, note=None)))
+    await call("add_inventory_count_lines", rq.add_inventory_count_lines(count["id"], body(b"barcode,quantity\n100,3\n999,1\n"), "csv"))
+    await call("fetch_inventory_count", rq.fetch_inventory_count(count["id"]))
+    await call("close_inventory_count", rq.close_inventory_count(count["id"]))
+    await call("fetch_inventory_report", rq.fetch_inventory_report(count["id"]))
+    count = await call("open_inventory_count", rq.open_inventory_count(ns(location_id=2, user_tg_id=1, note=None)))
+    await call("cancel_inventory_count", rq.cancel_inventory_count(count["id"]))
+    await call("log_sync", rq.log_sync(ns(entity_type="item", entity_id=1, message="")))
+    await call("create_stock_snapshot", rq.create_stock_snapshot(datetime(2100, 1, 1)))
+    await call("archive_operations", rq.archive_operations())
+    await call("fetch_stock_snapshots", rq.fetch_stock_snapshots())
+    await call("report_locations", rq.report_locations())
+    await call("report_daily", rq.report_daily(location_id=1))
+    await call("report_workers", rq.report_workers())
+    await call("rebuild_operation_rollups", rq.rebuild_operation_rollups())
+    await call("check_stock_levels", rq.check_stock_levels())
+    await call("rebuild_stock_levels", rq.rebuild_stock_levels())
+    await consume("export_items", rq.export_items("csv"))
+    await consume("export_operations", rq.export_operations("ndjson", location_id=1))
+    await consume("export_operations", rq.export_operations("csv", include_archived=True))
+
+    class NullSink:
+        async def send(self, batch_key, events):
+            pass
+
+    await call("outbox.drain_once", outbox.OutboxWorker(NullSink()).drain_once())
+    await call("outbox.outbox_metrics", outbox.outbox_metrics())
+    await call("outbox.purge_sent_events", outbox.purge_sent_events(outbox.utcnow()))
+
+    import workers
+    lease = workers.LeaderLease(None, None)
+    await call("workers.LeaderLease.acquire", lease.acquire())
+    await call("workers.LeaderLease.release", lease.release())
+    return captured_calls
+
+
+def audit(db_path: str, statements, verbose: bool):
+    conn = sqlite3.connect(db_path)
+    failures = []
+    seen = set()
+    for caller, statement, parameters in statements:
+        key = (caller, statement)
+        if key in seen or not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH", "INSERT")):
+            continue
+        seen.add(key)
+        if isinstance(parameters, list):
+            parameters = parameters[0] if parameters else ()
+        try:
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statement, parameters or ())]
+        except sqlite3.Error as e:
+            print(f"[{caller}] не удалось получить план: {e}\n  {statement[:200]}", file=sys.stderr)
+            continue
+        scans = [line for line in plan if SCAN_RE.match(line)]
+        flat = " ".join(statement.split()).upper()
+        if " LIMIT " in flat and " WHERE " not in flat:
+            scans = [line for line in scans if not INDEX_SCAN_RE.match(line)]
+        allowed = FULL_SCAN_ALLOWED.get(caller)
+        if verbose or (scans and not allowed):
+            status = "FAIL" if scans and not allowed else ("SCAN OK" if scans else "OK")
+            print(f"[{status}] {caller}: {' '.join(statement.split())[:300]}")
+            for line in plan:
+                print(f"    {line}")
+        if scans and not allowed:
+            failures.append((caller, statement, scans))
+    conn.close()
+    return failures, len(seen)
+
+
+async def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="sklad-audit-")
+    db_path = os.path.join(workdir, "audit.sqlite3")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{db_path}"
+    # A sink enables the outbox, so the enqueue paths are audited too; nothing is sent
+    os.environ["SYNC_SINK"] = "file:" + os.path.join(workdir, "outbox")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import migrations
+    import outbox
+    import requests as rq
+    from database import engine
+    from sqlalchemy import event
+
+    statements = []
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _capture(conn, cursor, statement, parameters, context, executemany):
+        caller = _current_call.get()
+        if caller is not None:
+            statements.append((caller, statement, parameters))
+
+    # The app prints to stdout; keep stdout for the report only
+    with contextlib.redirect_stdout(sys.stderr):
+        await migrations.init_db()
+        await exercise(rq, outbox)
+    await engine.dispose()
+
+    failures, checked = audit(db_path, statements, args.verbose)
+    print(f"Проверено запросов: {checked}, с полным сканированием: {len(failures)}")
+    for caller, statement, scans in failures:
+        print(f"  {caller}: {'; '.join(scans)}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
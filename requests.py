@@ -1,18 +1,47 @@
-from sqlalchemy import select, update, delete, func
+from sqlalchemy import select, insert, update, delete, exists, func, case, or_, text, literal, literal_column, tuple_, type_coerce, union_all, String
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import aliased
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 from fastapi import HTTPException
 import logging
+import asyncio
+import base64
+import codecs
+import csv
+import enum
+import io
+import json
+import time
+from datetime import date, datetime, timedelta
 from models import (
-    User, Item, Location, Operation,
-    OperationType, SyncLog, UserRole
+    User, Item, Location, Operation, ArchivedOperation, OperationDailyRollup,
+    InventoryCount, InventoryCountLine, InventoryCountStatus,
+    OperationType, OutboxEvent, StockLevel, StockSnapshot, StockSnapshotRow, SyncLog, UserRole
 )
-from database import async_session # Assuming database.py has async_session
+from database import async_session, write_session # Assuming database.py has async_session
+from cache import TTLCache, MISSING, Snapshot
+import outbox
+import feed
+import group_commit
+import models
 import os
 from dotenv import load_dotenv
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Кэш сканирования: barcode -> serialized item, или None для несуществующего штрихкода
+item_cache = TTLCache(
+    maxsize=int(os.environ.get("ITEM_CACHE_SIZE", "5000")),
+    ttl=float(os.environ.get("ITEM_CACHE_TTL", "300")),
+)
+
+# Справочники: "locations" -> Snapshot списка локаций, ("user", tg_id) -> Snapshot профиля или None
+reference_cache = TTLCache(
+    maxsize=int(os.environ.get("REFERENCE_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("REFERENCE_CACHE_TTL", "600")),
+)
+
 # Assuming this comes from main.py's Pydantic models or a shared schema file
 # class ItemCreate(BaseModel): # You might need to import this or define it here if not shared
 #     barcode: str
@@ -27,131 +56,325 @@ async def fetch_user_by_tg_id(tg_id: int, session: AsyncSession):
     user = await session.scalar(select(User).where(User.tg_id == tg_id))
     return user
 
-async def get_items_by_user_tg(tg_id: int):
+async def fetch_user_snapshot(tg_id: int):
+    key = ("user", tg_id)
+    snapshot = reference_cache.get(key)
+    if snapshot is MISSING:
+        generation = reference_cache.generation
+        async with async_session() as session:
+            user = await fetch_user_by_tg_id(tg_id, session)
+            snapshot = Snapshot.of(serialize_user(user)) if user else None
+        reference_cache.set(key, snapshot, generation)
+    return snapshot
+
+def _encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _db_timestamp(value: datetime):
+    # Timestamps are written by SQLite's CURRENT_TIMESTAMP ("YYYY-MM-DD HH:MM:SS", no
+    # microseconds), while a bound datetime is rendered with ".000000". Comparing the raw
+    # text keeps the comparison exact and lets SQLite use an index on the column.
+    text = value.strftime("%Y-%m-%d %H:%M:%S")
+    if value.microsecond:
+        text += value.strftime(".%f")
+    return type_coerce(text, String)
+
+def _decode_cursor(cursor: str):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный курсор.")
+
+# Columns of list responses, in the key order of serialize_item / serialize_operation.
+# List endpoints build plain dicts straight from these row tuples: no ORM objects,
+# datetimes and enums are left to the JSON encoder.
+ITEM_COLUMNS = (
+    Item.id, Item.user_id, Item.barcode, Item.name, Item.sku, Item.quantity, Item.location_id,
+    Item.description, Item.external_id, Item.status, Item.updated_at, Item.last_operation_id,
+)
+ITEM_KEYS = tuple(c.key for c in ITEM_COLUMNS)
+OPERATION_KEYS = (
+    "id", "user_id", "item_id", "location_id", "type", "quantity", "note",
+    "from_location_id", "idempotency_key", "created_at",
+)
+
+async def get_items_by_user_tg(
+    tg_id: int,
+    limit: int = 100,
+    cursor: str | None = None,
+    order_by: str = "id",
+    location_id: int | None = None,
+    status: str | None = None,
+    updated_since: datetime | None = None,
+    include_last_operation: bool = False,
+):
+    # Keyset pagination: the cursor carries the sort key of the last returned row,
+    # so every page is an index range read no matter how deep the client pages.
+    # An unknown tg_id simply has no items, nothing is written on this read path.
+    last_operation = aliased(Operation)
+    columns = ITEM_COLUMNS
+    if include_last_operation:
+        columns += tuple(getattr(last_operation, key) for key in OPERATION_KEYS)
+    stmt = select(*columns).join(User, Item.user_id == User.id).where(User.tg_id == tg_id)
+    if location_id is not None:
+        stmt = stmt.where(Item.location_id == location_id)
+    if status is not None:
+        stmt = stmt.where(Item.status == status)
+    if updated_since is not None:
+        stmt = stmt.where(Item.updated_at >= _db_timestamp(updated_since))
+
+    if order_by == "updated_at":
+        stmt = stmt.order_by(Item.updated_at.desc(), Item.id.desc())
+        if cursor:
+            try:
+                last_updated_at, last_id = _decode_cursor(cursor)
+                last_updated_at = datetime.fromisoformat(last_updated_at)
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="Некорректный курсор.")
+            stmt = stmt.where(tuple_(Item.updated_at, Item.id) < tuple_(_db_timestamp(last_updated_at), last_id))
+    else:
+        stmt = stmt.order_by(Item.id)
+        if cursor:
+            try:
+                (last_id,) = _decode_cursor(cursor)
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="Некорректный курсор.")
+            stmt = stmt.where(Item.id > last_id)
+
+    if include_last_operation:
+        stmt = stmt.outerjoin(last_operation, last_operation.id == Item.last_operation_id)
+
     async with async_session() as session:
-        async with session.begin():
-            user = await session.scalar(select(User).where(User.tg_id == tg_id))
-            if not user:
-                user = User(tg_id=tg_id)
-                session.add(user)
-                await session.flush()
-                await session.refresh(user)
+        rows = (await session.execute(stmt.limit(limit + 1))).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if order_by == "updated_at":
+            next_cursor = _encode_cursor(last.updated_at.isoformat(), last.id)
+        else:
+            next_cursor = _encode_cursor(last.id)
 
-            items = await session.scalars(select(Item).where(Item.user_id == user.id))
-            return [serialize_item(item) for item in items]
+    width = len(ITEM_KEYS)
+    if not include_last_operation:
+        return {"items": [dict(zip(ITEM_KEYS, row)) for row in rows], "next_cursor": next_cursor}
+    items = []
+    for row in rows:
+        data = dict(zip(ITEM_KEYS, row[:width]))
+        data["last_operation"] = dict(zip(OPERATION_KEYS, row[width:])) if row[width] is not None else None
+        items.append(data)
+    return {"items": items, "next_cursor": next_cursor}
 
 async def scan_or_create_item(barcode: str):
-    async with async_session() as session:
-        async with session.begin():
-            item = await session.scalar(select(Item).where(Item.barcode == barcode))
-            if item:
-                return {"status": "exists", "item": serialize_item(item)}
-            else:
-                # When an item is 'created' (doesn't exist yet),
-                # you return a basic item dict.
-                # The actual creation happens via the /api/items POST endpoint.
-                return {"status": "created", "item": {"barcode": barcode, "name": "Новый товар"}}
+    item = item_cache.get(barcode)
+    if item is MISSING:
+        generation = item_cache.generation
+        async with async_session() as session:
+            row = await session.scalar(select(Item).where(Item.barcode == barcode))
+            item = serialize_item(row) if row else None
+        item_cache.set(barcode, item, generation)
+
+    if item:
+        return {"status": "exists", "item": item}
+    else:
+        # When an item is 'created' (doesn't exist yet),
+        # you return a basic item dict.
+        # The actual creation happens via the /api/items POST endpoint.
+        return {"status": "created", "item": {"barcode": barcode, "name": "Новый товар"}}
 
 # NEW FUNCTION TO CREATE AN ITEM
 async def create_item(item_data): # item_data будет экземпляром ItemCreate Pydantic модели
-    async with async_session() as session:
-        async with session.begin():
-            # Проверка на уникальность штрихкода
-            existing_item = await session.scalar(select(Item).where(Item.barcode == item_data.barcode))
-            if existing_item:
-                raise HTTPException(status_code=400, detail="Товар с таким штрихкодом уже существует.")
-
-            # Проверка наличия локации
-            if item_data.location_id:
-                location = await session.scalar(select(Location).where(Location.id == item_data.location_id))
-                if not location:
-                    raise HTTPException(status_code=400, detail="Указанная локация не найдена.")
-            else:
-                raise HTTPException(status_code=400, detail="Локация для нового товара должна быть указана.")
-
-            # Найдите внутреннего пользователя по user_tg_id, пришедшему с фронтенда
-            user_from_db = await session.scalar(select(User).where(User.tg_id == item_data.user_tg_id)) # <--- ИСПОЛЬЗУЕМ user_tg_id ИЗ ItemCreate
-            if not user_from_db:
-                raise HTTPException(status_code=400, detail="Пользователь Telegram не найден в базе данных. Пожалуйста, убедитесь, что вы зарегистрированы.")
-
-
-            new_item = Item(
-                barcode=item_data.barcode,
-                name=item_data.name,
-                sku=item_data.sku,
-                location_id=item_data.location_id,
-                quantity=item_data.quantity,
-                description=item_data.note,
-                user_id=user_from_db.id, # <--- ЭТО САМОЕ ВАЖНОЕ: Используем внутренний ID пользователя
+    async with write_session() as session:
+        # Проверка на уникальность штрихкода
+        existing_item = await session.scalar(select(Item).where(Item.barcode == item_data.barcode))
+        if existing_item:
+            raise HTTPException(status_code=400, detail="Товар с таким штрихкодом уже существует.")
+
+        # Проверка наличия локации
+        if item_data.location_id:
+            location = await session.scalar(select(Location).where(Location.id == item_data.location_id))
+            if not location:
+                raise HTTPException(status_code=400, detail="Указанная локация не найдена.")
+        else:
+            raise HTTPException(status_code=400, detail="Локация для нового товара должна быть указана.")
+
+        # Найдите внутреннего пользователя по user_tg_id, пришедшему с фронтенда
+        user_from_db = await session.scalar(select(User).where(User.tg_id == item_data.user_tg_id)) # <--- ИСПОЛЬЗУЕМ user_tg_id ИЗ ItemCreate
+        if not user_from_db:
+            raise HTTPException(status_code=400, detail="Пользователь Telegram не найден в базе данных. Пожалуйста, убедитесь, что вы зарегистрированы.")
+
+
+        new_item = Item(
+            barcode=item_data.barcode,
+            name=item_data.name,
+            sku=item_data.sku,
+            location_id=item_data.location_id,
+            quantity=item_data.quantity,
+            description=item_data.note,
+            user_id=user_from_db.id, # <--- ЭТО САМОЕ ВАЖНОЕ: Используем внутренний ID пользователя
+        )
+        session.add(new_item)
+        await session.flush()
+
+        # The opening quantity goes through the ledger like any other receipt,
+        # so stock_levels can always be rebuilt from operations
+        if new_item.quantity:
+            operation = Operation(
+                user_id=user_from_db.id,
+                item_id=new_item.id,
+                location_id=new_item.location_id,
+                type=OperationType.receive,
+                quantity=new_item.quantity,
+                note="Начальный остаток",
             )
-            session.add(new_item)
+            session.add(operation)
+            session.add(StockLevel(item_id=new_item.id, location_id=new_item.location_id, quantity=new_item.quantity))
+            await session.flush()
+            new_item.last_operation_id = operation.id
             await session.flush()
-            await session.refresh(new_item)
 
-            return serialize_item(new_item)
+        await session.refresh(new_item)
+        serialized = serialize_item(new_item)
+        if outbox.ENABLED:
+            await session.execute(insert(OutboxEvent), [outbox.outbox_event("item", new_item.id, "item.created", serialized)])
 
+    outbox.notify()
+    feed.publish_stock_change(
+        _stock_event(None, "create", serialized["id"], serialized["quantity"], serialized["quantity"], serialized["location_id"], [serialized["location_id"]]),
+        serialized["id"], [serialized["location_id"]],
+    )
+    # Replaces a cached miss for this barcode once the row is committed
+    item_cache.invalidate(serialized["barcode"])
+    item_cache.set(serialized["barcode"], serialized)
+    return serialized
+
+
+def _fts_query(q: str):
+    # Every word becomes a quoted term, so user input can't inject FTS5 syntax. Words of
+    # two and more characters match as prefixes; a single character would expand to a
+    # large part of the vocabulary, so it has to match a whole token.
+    terms = []
+    for word in q.split():
+        term = '"' + word.replace('"', '""') + '"'
+        terms.append(term + "*" if len(word) > 1 else term)
+    return " ".join(terms)
+
+async def search_items(q: str, limit: int = 20):
+    q = q.strip()
+    if not q:
+        return {"items": []}
+
+    if models.search_enabled:
+        # FTS5 can stop early on "ORDER BY rank LIMIT n" (rank is BM25 with name weighted
+        # highest, see migrations.ITEMS_FTS_RANK), so the limit is applied inside the index
+        # query and only the winners are joined to items. An exact barcode hit goes first.
+        matches = (
+            select(models.items_fts.c.rowid, literal_column("rank").label("rank"))
+            .where(text("items_fts MATCH :fts_query").bindparams(fts_query=_fts_query(q)))
+            .order_by(literal_column("rank"))
+            .limit(limit)
+            .subquery()
+        )
+        stmt = (
+            select(*ITEM_COLUMNS)
+            .join(matches, matches.c.rowid == Item.id)
+            .order_by((Item.barcode == q).desc(), matches.c.rank)
+        )
+    else:
+        # % and _ typed by the user are matched literally, not as wildcards
+        literal = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        pattern = f"%{literal}%"
+        stmt = (
+            select(*ITEM_COLUMNS)
+            .where(or_(
+                Item.name.ilike(pattern, escape="\\"), Item.sku.ilike(pattern, escape="\\"),
+                Item.barcode.like(f"{literal}%", escape="\\"), Item.description.ilike(pattern, escape="\\"),
+            ))
+            .order_by((Item.barcode == q).desc(), Item.name)
+            .limit(limit)
+        )
 
-async def create_new_location(location_data):
     async with async_session() as session:
-        async with session.begin():
-            # Проверяем на уникальность кода локации
+        rows = await session.execute(stmt)
+        return {"items": [dict(zip(ITEM_KEYS, row)) for row in rows]}
+
+
+async def create_new_location(location_data):
+    async with write_session() as session:
+        # Проверяем на уникальность кода локации
+        existing_location = await session.scalar(
+            select(Location).where(Location.code == location_data.code)
+        )
+        if existing_location:
+            raise HTTPException(status_code=400, detail="Локация с таким кодом уже существует.")
+
+        new_location = Location(
+            name=location_data.name,
+            code=location_data.code,
+            description=location_data.description
+        )
+        session.add(new_location)
+        await session.flush()
+        await session.refresh(new_location)
+    reference_cache.invalidate("locations")
+    return {"status": "ok", "location": serialize_location(new_location)}
+
+async def update_existing_location(location_id: int, location_data):
+    async with write_session() as session:
+        location = await session.scalar(select(Location).where(Location.id == location_id))
+        if not location:
+            raise HTTPException(status_code=404, detail="Локация не найдена")
+
+        if location_data.code and location_data.code != location.code:
             existing_location = await session.scalar(
-                select(Location).where(Location.code == location_data.code)
+                select(Location).where(Location.code == location_data.code, Location.id != location_id)
             )
             if existing_location:
                 raise HTTPException(status_code=400, detail="Локация с таким кодом уже существует.")
 
-            new_location = Location(
-                name=location_data.name,
-                code=location_data.code,
-                description=location_data.description
-            )
-            session.add(new_location)
-            await session.flush()
-            await session.refresh(new_location)
-            return {"status": "ok", "location": {"id": new_location.id, "name": new_location.name, "code": new_location.code, "description": new_location.description}}
+        if location_data.name is not None:
+            location.name = location_data.name
+        if location_data.code is not None:
+            location.code = location_data.code
+        if location_data.description is not None:
+            location.description = location_data.description
 
-async def update_existing_location(location_id: int, location_data):
-    async with async_session() as session:
-        async with session.begin():
-            location = await session.scalar(select(Location).where(Location.id == location_id))
-            if not location:
-                raise HTTPException(status_code=404, detail="Локация не найдена")
-
-            if location_data.code and location_data.code != location.code:
-                existing_location = await session.scalar(
-                    select(Location).where(Location.code == location_data.code, Location.id != location_id)
-                )
-                if existing_location:
-                    raise HTTPException(status_code=400, detail="Локация с таким кодом уже существует.")
+        await session.flush()
+        await session.refresh(location)
+    reference_cache.invalidate("locations")
+    return {"status": "ok", "location": serialize_location(location)}
 
-            if location_data.name is not None:
-                location.name = location_data.name
-            if location_data.code is not None:
-                location.code = location_data.code
-            if location_data.description is not None:
-                location.description = location_data.description
+async def delete_existing_location(location_id: int):
+    async with write_session() as session:
+        location = await session.scalar(select(Location).where(Location.id == location_id))
+        if not location:
+            raise HTTPException(status_code=404, detail="Локация не найдена")
 
-            await session.flush()
-            await session.refresh(location)
-            return {"status": "ok", "location": {"id": location.id, "name": location.name, "code": location.code, "description": location.description}}
+        # EXISTS stops at the first row found through the location indexes
+        in_use = await session.scalar(select(or_(
+            exists().where(Item.location_id == location_id),
+            exists().where(Operation.location_id == location_id),
+            exists().where(Operation.from_location_id == location_id),
+        )))
 
-async def delete_existing_location(location_id: int):
-    async with async_session() as session:
-        async with session.begin():
-            location = await session.scalar(select(Location).where(Location.id == location_id))
-            if not location:
-                raise HTTPException(status_code=404, detail="Локация не найдена")
+        if in_use:
+            raise HTTPException(status_code=400, detail="Невозможно удалить локацию, так как с ней связаны товары или операции. Сначала переместите или удалите их.")
 
-            associated_items = await session.scalar(select(func.count(Item.id)).where(Item.location_id == location_id))
-            associated_operations = await session.scalar(select(func.count(Operation.id)).where(Operation.location_id == location_id))
+        # Archived operations and snapshot rows are history that replay and exports still read
+        archived = await session.scalar(select(or_(
+            exists().where(ArchivedOperation.location_id == location_id),
+            exists().where(ArchivedOperation.from_location_id == location_id),
+            exists().where(StockSnapshotRow.location_id == location_id),
+        )))
 
-            if associated_items > 0 or associated_operations > 0:
-                raise HTTPException(status_code=400, detail="Невозможно удалить локацию, так как с ней связаны товары или операции. Сначала переместите или удалите их.")
+        if archived:
+            raise HTTPException(status_code=400, detail="Невозможно удалить локацию, так как на нее ссылаются архивные операции или снимки остатков.")
 
-            await session.delete(location)
-            await session.flush()
-            return {"status": "ok", "message": f"Локация {location_id} удалена."}
+        await session.delete(location)
+        await session.flush()
+    reference_cache.invalidate("locations")
+    return {"status": "ok", "message": f"Локация {location_id} удалена."}
 
 async def fetch_location_by_id(location_id: int, session: AsyncSession):
     location = await session.scalar(select(Location).where(Location.id == location_id))
@@ -159,133 +382,1505 @@ async def fetch_location_by_id(location_id: int, session: AsyncSession):
 
 async def fetch_all_locations():
     async with async_session() as session:
-        async with session.begin():
-            locations = await session.scalars(select(Location))
-            return [{"id": loc.id, "name": loc.name, "code": loc.code, "description": loc.description} for loc in locations]
+        locations = await session.scalars(select(Location))
+        return [serialize_location(loc) for loc in locations]
+
+async def fetch_locations_snapshot():
+    snapshot = reference_cache.get("locations")
+    if snapshot is MISSING:
+        generation = reference_cache.generation
+        snapshot = Snapshot.of(await fetch_all_locations())
+        reference_cache.set("locations", snapshot, generation)
+    return snapshot
+
+def _apply_operation(op, item, user, location, stock):
+    # Validates a single operation against already loaded rows and applies it
+    # to the ORM objects. Nothing is flushed here: callers decide when to hit the DB.
+    # `stock` maps (item_id, location_id) -> StockLevel for the items involved,
+    # rows created here are added to it.
+    if not item:
+        raise HTTPException(status_code=404, detail="Товар не найден.")
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден.")
+    if not location:
+        raise HTTPException(status_code=404, detail="Локация не найдена.")
+
+    try:
+        op_type = OperationType(op.type)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неизвестный тип операции.")
+
+    def level(location_id):
+        key = (item.id, location_id)
+        if key not in stock:
+            stock[key] = StockLevel(item_id=item.id, location_id=location_id, quantity=0)
+        return stock[key]
+
+    from_location_id = getattr(op, "from_location_id", None)
+    if op_type == OperationType.ship and stock.get((item.id, location.id), _NO_STOCK).quantity < op.quantity:
+        raise HTTPException(status_code=400, detail="Недостаточно товара для отгрузки.")
+    if op_type == OperationType.move and from_location_id is not None:
+        if stock.get((item.id, from_location_id), _NO_STOCK).quantity < op.quantity:
+            raise HTTPException(status_code=400, detail="Недостаточно товара в исходной локации.")
+
+    operation = Operation(
+        user_id=user.id,
+        item_id=item.id,
+        location_id=location.id,
+        from_location_id=from_location_id if op_type == OperationType.move else None,
+        type=op_type,
+        quantity=op.quantity,
+        note=op.note
+    )
+
+    if op_type == OperationType.receive:
+        level(location.id).quantity += op.quantity
+        item.quantity += op.quantity
+    elif op_type == OperationType.ship:
+        level(location.id).quantity -= op.quantity
+        item.quantity -= op.quantity
+    elif op_type == OperationType.inventory:
+        current = level(location.id)
+        item.quantity += op.quantity - current.quantity
+        current.quantity = op.quantity
+    elif op_type == OperationType.move and from_location_id is not None:
+        # Partial move: debit the source location and credit the destination.
+        # The item follows the goods only once its home location is emptied.
+        source = level(from_location_id)
+        source.quantity -= op.quantity
+        level(location.id).quantity += op.quantity
+        if source.quantity == 0 and item.location_id == from_location_id:
+            item.location_id = location.id
+    elif op_type == OperationType.move:
+        # Without a source location the whole item record is moved (the behaviour
+        # `ScanItem.vue` relies on): all of its stock ends up at the destination.
+        for (item_id, _), row in stock.items():
+            if item_id == item.id:
+                row.quantity = 0
+        level(location.id).quantity = item.quantity
+        item.location_id = location.id
+
+    return operation
+
+# Stand-in for a missing stock_levels row
+_NO_STOCK = StockLevel(quantity=0)
+
+def _upsert_stock(item_id: int, location_id: int, quantity, replace: bool = False):
+    # INSERT ... ON CONFLICT for stock_levels: adds `quantity` to the row, or sets it with replace=True
+    stmt = sqlite_insert(StockLevel).values(item_id=item_id, location_id=location_id, quantity=quantity)
+    return stmt.on_conflict_do_update(
+        index_elements=[StockLevel.item_id, StockLevel.location_id],
+        set_={
+            "quantity": stmt.excluded.quantity if replace else StockLevel.quantity + stmt.excluded.quantity,
+            "updated_at": func.now(),
+        },
+    )
+
+def _take_stock(item_id: int, location_id: int, quantity: int):
+    # Conditional debit, returns no row when the location doesn't hold enough
+    return (
+        update(StockLevel)
+        .where(
+            StockLevel.item_id == item_id,
+            StockLevel.location_id == location_id,
+            StockLevel.quantity >= quantity,
+        )
+        .values(quantity=StockLevel.quantity - quantity)
+        .returning(StockLevel.quantity)
+        .execution_options(synchronize_session=False)
+    )
 
 async def process_operation(op):
-    async with async_session() as session:
-        async with session.begin():
-            item = await session.get(Item, op.item_id)
-            user = await fetch_user_by_tg_id(op.user_id, session)
-            location = await session.get(Location, op.location_id)
-
-            if not item:
-                raise HTTPException(status_code=404, detail="Товар не найден.")
-            if not user:
-                raise HTTPException(status_code=404, detail="Пользователь не найден.")
-            if not location:
-                raise HTTPException(status_code=404, detail="Локация не найдена.")
+    # In group-commit mode the operation joins the writer's next shared transaction
+    if group_commit.writer:
+        return await group_commit.writer.submit(op)
+    async with write_session() as session:
+        result, after_commit = await apply_operation(session, op)
+    after_commit()
+    return result
 
-            if op.type == "ship" and item.quantity < op.quantity:
-                raise HTTPException(status_code=400, detail="Недостаточно товара для отгрузки.")
 
-            operation = Operation(
-                user_id=user.id,
-                item_id=item.id,
-                location_id=location.id,
-                type=OperationType(op.type),
-                quantity=op.quantity,
-                note=op.note
+async def apply_operation(session: AsyncSession, op):
+    """
+    Проводит одну операцию в транзакции вызывающего.
+
+    Returns the response and a callback with the side effects (outbox wakeup, item
+    cache, stock feed) that may only run after the transaction has committed.
+    """
+    try:
+        op_type = OperationType(op.type)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неизвестный тип операции.")
+    from_location_id = getattr(op, "from_location_id", None) if op_type == OperationType.move else None
+    idempotency_key = getattr(op, "idempotency_key", None)
+
+    user = await fetch_user_by_tg_id(op.user_id, session)
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден.")
+    location = await session.get(Location, op.location_id)
+    if not location:
+        raise HTTPException(status_code=404, detail="Локация не найдена.")
+
+    # Write section: insert the operation and apply it with conditional UPDATEs,
+    # so the stock checks and the changes happen atomically in SQL.
+    # Raising anywhere below rolls back everything this operation wrote
+    # (the whole transaction, or its savepoint in group-commit mode).
+    # A retried request hits the unique idempotency key and inserts nothing
+    operation_id = await session.scalar(
+        sqlite_insert(Operation)
+        .values(
+            user_id=user.id,
+            item_id=op.item_id,
+            location_id=location.id,
+            from_location_id=from_location_id,
+            type=op_type,
+            quantity=op.quantity,
+            note=op.note,
+            idempotency_key=idempotency_key,
+        )
+        .on_conflict_do_nothing(index_elements=[Operation.idempotency_key])
+        .returning(Operation.id)
+    )
+    if operation_id is None:
+        return await _duplicate_operation(session, idempotency_key, op), _nothing_after_commit
+
+    stmt = update(Item).where(Item.id == op.item_id).values(last_operation_id=operation_id)
+    affected_locations = [location.id, from_location_id]
+    if op_type == OperationType.receive:
+        await session.execute(_upsert_stock(op.item_id, location.id, op.quantity))
+        stmt = stmt.values(quantity=Item.quantity + op.quantity)
+    elif op_type == OperationType.ship:
+        if await session.scalar(_take_stock(op.item_id, location.id, op.quantity)) is None:
+            await _raise_missing_item(session, op.item_id, "Недостаточно товара для отгрузки.")
+        stmt = stmt.values(quantity=Item.quantity - op.quantity)
+    elif op_type == OperationType.inventory:
+        await session.execute(_upsert_stock(op.item_id, location.id, op.quantity, replace=True))
+        stmt = stmt.values(
+            quantity=select(func.coalesce(func.sum(StockLevel.quantity), 0))
+            .where(StockLevel.item_id == op.item_id)
+            .scalar_subquery()
+        )
+    elif op_type == OperationType.move and from_location_id is not None:
+        remaining = await session.scalar(_take_stock(op.item_id, from_location_id, op.quantity))
+        if remaining is None:
+            await _raise_missing_item(session, op.item_id, "Недостаточно товара в исходной локации.")
+        await session.execute(_upsert_stock(op.item_id, location.id, op.quantity))
+        if remaining == 0:
+            stmt = stmt.values(
+                location_id=case((Item.location_id == from_location_id, location.id), else_=Item.location_id)
             )
-            session.add(operation)
+    elif op_type == OperationType.move:
+        # The whole item record is moved, see _apply_operation
+        emptied = await session.scalars(
+            update(StockLevel)
+            .where(StockLevel.item_id == op.item_id, StockLevel.location_id != location.id)
+            .values(quantity=0)
+            .returning(StockLevel.location_id)
+            .execution_options(synchronize_session=False)
+        )
+        affected_locations += emptied.all()
+        await session.execute(_upsert_stock(
+            op.item_id,
+            location.id,
+            select(Item.quantity).where(Item.id == op.item_id).scalar_subquery(),
+            replace=True,
+        ))
+        stmt = stmt.values(location_id=location.id)
 
-            if op.type == "receive":
-                item.quantity += op.quantity
-            elif op.type == "ship":
-                item.quantity -= op.quantity
-            elif op.type == "inventory":
-                item.quantity = op.quantity
-            elif op.type == "move":
-                # For move operation, quantity on the item doesn't change, only location
-                item.location_id = location.id
-                # If quantity is provided for move, it implies moving 'op.quantity' from current location
-                # to new location. This requires more complex logic (deduct from old, add to new)
-                # For simplicity here, assuming 'move' means moving the *entire* item record to a new location.
-                # If partial moves are intended, item.quantity needs to be handled differently (e.g., create new item record for moved quantity).
-                # The current `move` implementation in `ScanItem.vue` only takes a `location_id`, not quantity, for move.
-                # So if `quantity` is used in `OperationData` for move, it might be extraneous or imply a specific behavior.
-                # Let's assume the frontend sends quantity 1 for move and we just update location.
-                # If partial moves are desired, the logic needs to be more complex.
-                pass # Location update is already handled by item.location_id = location.id
-
-            item.last_operation_id = operation.id # Update the last operation ID
+    row = (await session.execute(
+        stmt.returning(Item.barcode, Item.quantity, Item.location_id).execution_options(synchronize_session=False)
+    )).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Товар не найден.")
 
-            await session.flush()
-            # No need to refresh item explicitly if only quantity and last_operation_id are changed
-            # These changes are reflected in the session and will be committed.
-            # Refreshing operation might be useful if you need its ID immediately before returning.
-            await session.refresh(operation)
+    if outbox.ENABLED:
+        await session.execute(insert(OutboxEvent), [outbox.outbox_event("operation", operation_id, "operation.created", {
+            "operation_id": operation_id,
+            "type": op_type.value,
+            "item_id": op.item_id,
+            "barcode": row.barcode,
+            "location_id": location.id,
+            "from_location_id": from_location_id,
+            "user_tg_id": user.tg_id,
+            "quantity": op.quantity,
+            "note": op.note,
+            "item_quantity": row.quantity,
+            "item_location_id": row.location_id,
+        })])
 
-            return {"status": "ok", "operation_id": operation.id}
+    def after_commit():
+        outbox.notify()
+        item_cache.invalidate(row.barcode)
+        feed.publish_stock_change(
+            _stock_event(operation_id, op_type.value, op.item_id, op.quantity, row.quantity, row.location_id, affected_locations),
+            op.item_id, affected_locations,
+        )
 
-async def log_sync(data):
+    return {"status": "ok", "operation_id": operation_id, "quantity": row.quantity}, after_commit
+
+def _nothing_after_commit():
+    pass
+
+def _stock_event(operation_id, op_type: str, item_id: int, quantity: int, item_quantity: int, item_location_id: int, locations):
+    # Compact payload of the stock feed, item state as committed
+    return {
+        "operation_id": operation_id,
+        "op": op_type,
+        "item_id": item_id,
+        "quantity": quantity,
+        "item_quantity": item_quantity,
+        "item_location_id": item_location_id,
+        "locations": sorted({loc for loc in locations if loc is not None}),
+    }
+
+async def _raise_missing_item(session: AsyncSession, item_id: int, detail: str):
+    if not await session.scalar(select(Item.id).where(Item.id == item_id)):
+        raise HTTPException(status_code=404, detail="Товар не найден.")
+    raise HTTPException(status_code=400, detail=detail)
+
+def _same_operation(previous: Operation, op):
+    # An idempotency key may only be replayed with the operation it was first used for
+    return (previous.item_id, previous.location_id, previous.type.value, previous.quantity) == (
+        op.item_id, op.location_id, op.type, op.quantity
+    )
+
+async def _duplicate_operation(session: AsyncSession, idempotency_key: str, op):
+    # The operation was applied by an earlier attempt: report it instead of applying it twice
+    previous = await session.scalar(select(Operation).where(Operation.idempotency_key == idempotency_key))
+    if not _same_operation(previous, op):
+        raise HTTPException(status_code=409, detail="Ключ идемпотентности уже использован для другой операции.")
+    quantity = await session.scalar(select(Item.quantity).where(Item.id == previous.item_id))
+    return {"status": "duplicate", "operation_id": previous.id, "quantity": quantity}
+
+async def process_operations_batch(ops, include_stock: bool = False):
+    # Applies a whole list of operations (e.g. one scanned pallet) in a single transaction.
+    # A bad entry is reported in its result slot instead of rolling back the rest of the batch.
+    # Idempotency keys are looked up inside the write transaction, so a key committed by a
+    # concurrent request is already visible here and comes back as a duplicate.
+    async with write_session() as session:
+        outcomes, applied, items, stock = await _apply_batch(session, ops)
+    _publish_batch(applied, items, stock)
+
+    results = []
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, HTTPException):
+            results.append({"index": index, "status": "error", "status_code": outcome.status_code, "detail": outcome.detail})
+        else:
+            results.append({"index": index, "status": outcome["status"], "operation_id": outcome["operation_id"]})
+    duplicates = sum(1 for r in results if r["status"] == "duplicate")
+    response = {
+        "status": "ok",
+        "applied": len(applied),
+        "duplicates": duplicates,
+        "failed": len(ops) - len(applied) - duplicates,
+        "results": results,
+    }
+    if include_stock:
+        # Resulting stock of every item the batch referenced, as committed above
+        response["stock"] = [
+            {
+                "item_id": item.id,
+                "quantity": item.quantity,
+                "location_id": item.location_id,
+                "locations": [
+                    {"location_id": location_id, "quantity": level.quantity}
+                    for (item_id, location_id), level in sorted(stock.items())
+                    if item_id == item.id and level.quantity != 0
+                ],
+            }
+            for item in sorted(items.values(), key=lambda i: i.id)
+        ]
+    return response
+
+async def apply_operation_group(session: AsyncSession, ops):
+    """
+    Проводит группу одиночных операций в транзакции вызывающего (режим групповой фиксации).
+
+    Returns one entry per operation, the response of process_operation or the
+    HTTPException it would have raised, and the after-commit callback.
+    """
+    outcomes, applied, items, stock = await _apply_batch(session, ops)
+    return outcomes, lambda: _publish_batch(applied, items, stock)
+
+async def _apply_batch(session: AsyncSession, ops):
+    # Referenced rows are loaded with one IN (...) query per table and every entry is
+    # validated against them in memory, so a bad entry writes nothing and the others
+    # go out in two flushes. Entries whose idempotency key was already applied, by an
+    # earlier request or earlier in this list, are reported as duplicates.
+    # Returns (outcomes, applied, items, stock): per entry a response dict or an
+    # HTTPException, the (index, Operation) pairs written, and the rows they touched.
+    item_ids = {op.item_id for op in ops}
+    tg_ids = {op.user_id for op in ops}
+    location_ids = {op.location_id for op in ops}
+
+    keys = {op.idempotency_key for op in ops if getattr(op, "idempotency_key", None)}
+
+    items = {}
+    users = {}
+    locations = {}
+    stock = {}
+    seen = {}
+    if keys:
+        seen = {o.idempotency_key: o for o in await session.scalars(
+            select(Operation).where(Operation.idempotency_key.in_(keys))
+        )}
+    if ops:
+        items = {i.id: i for i in await session.scalars(select(Item).where(Item.id.in_(item_ids)))}
+        users = {u.tg_id: u for u in await session.scalars(select(User).where(User.tg_id.in_(tg_ids)))}
+        locations = {loc.id: loc for loc in await session.scalars(select(Location).where(Location.id.in_(location_ids)))}
+        stock = {
+            (s.item_id, s.location_id): s
+            for s in await session.scalars(select(StockLevel).where(StockLevel.item_id.in_(item_ids)))
+        }
+
+    outcomes = []
+    applied = []
+    duplicates = []
+    states = {}
+    for index, op in enumerate(ops):
+        key = getattr(op, "idempotency_key", None)
+        try:
+            if key in seen:
+                if not _same_operation(seen[key], op):
+                    raise HTTPException(status_code=409, detail="Ключ идемпотентности уже использован для другой операции.")
+                duplicates.append((index, seen[key]))
+                outcomes.append(None)
+                continue
+            operation = _apply_operation(
+                op, items.get(op.item_id), users.get(op.user_id), locations.get(op.location_id), stock
+            )
+        except HTTPException as e:
+            outcomes.append(e)
+            continue
+        operation.idempotency_key = key
+        if key:
+            seen[key] = operation
+        session.add(operation)
+        applied.append((index, operation))
+        # Item state right after this entry, later entries may change it again
+        item = items[operation.item_id]
+        states[index] = (item.quantity, item.location_id)
+        outcomes.append({"status": "ok", "quantity": item.quantity})
+
+    # One flush inserts all operations and stock rows, a second one links items
+    # to their latest operation
+    session.add_all(stock.values())
+    await session.flush()
+    for index, operation in applied:
+        items[operation.item_id].last_operation_id = operation.id
+        outcomes[index]["operation_id"] = operation.id
+    for index, operation in duplicates:
+        item = items.get(operation.item_id)
+        outcomes[index] = {"status": "duplicate", "operation_id": operation.id, "quantity": item.quantity if item else 0}
+    await session.flush()
+
+    if applied and outbox.ENABLED:
+        await session.execute(insert(OutboxEvent), [
+            outbox.outbox_event("operation", operation.id, "operation.created", {
+                "operation_id": operation.id,
+                "type": operation.type.value,
+                "item_id": operation.item_id,
+                "barcode": items[operation.item_id].barcode,
+                "location_id": operation.location_id,
+                "from_location_id": operation.from_location_id,
+                "user_tg_id": ops[index].user_id,
+                "quantity": operation.quantity,
+                "note": operation.note,
+                "item_quantity": states[index][0],
+                "item_location_id": states[index][1],
+            })
+            for index, operation in applied
+        ])
+    return outcomes, applied, items, stock
+
+def _publish_batch(applied, items, stock):
+    # After-commit side effects of _apply_batch
+    if not applied:
+        return
+    outbox.notify()
+    item_cache.invalidate(*{items[operation.item_id].barcode for _, operation in applied})
+    for _, operation in applied:
+        item = items[operation.item_id]
+        locations = [operation.location_id, operation.from_location_id]
+        if operation.type == OperationType.move and operation.from_location_id is None:
+            # A whole-item move may have emptied any location of the item
+            locations += [location_id for (item_id, location_id) in stock if item_id == item.id]
+        feed.publish_stock_change(
+            _stock_event(operation.id, operation.type.value, item.id, operation.quantity, item.quantity, item.location_id, locations),
+            item.id, locations,
+        )
+
+async def sync_device_operations(device_id: str, ops):
+    # Offline queue of a scanner, replayed as a whole after reconnecting: already applied
+    # keys are skipped, the rest is applied in queue order in one transaction
+    if not all(getattr(op, "idempotency_key", None) for op in ops):
+        raise HTTPException(status_code=400, detail="У каждой операции из очереди устройства должен быть idempotency_key.")
+    result = await process_operations_batch(ops, include_stock=True)
+    logger.info(
+        f"Синхронизация устройства {device_id}: применено {result['applied']}, "
+        f"повторов {result['duplicates']}, ошибок {result['failed']}"
+    )
+    return {"device_id": device_id, **result}
+
+async def fetch_item_stock(item_id: int):
+    async with async_session() as session:
+        rows = await session.execute(
+            select(StockLevel.location_id, StockLevel.quantity)
+            .where(StockLevel.item_id == item_id, StockLevel.quantity != 0)
+            .order_by(StockLevel.location_id)
+        )
+        locations = [{"location_id": r.location_id, "quantity": r.quantity} for r in rows]
+    return {"item_id": item_id, "total": sum(loc["quantity"] for loc in locations), "locations": locations}
+
+async def fetch_location_stock(location_id: int):
     async with async_session() as session:
-        async with session.begin():
-            log = SyncLog(
-                entity_type=data.entity_type,
-                entity_id=data.entity_id,
-                status="success",
-                message=data.message
+        rows = await session.execute(
+            select(StockLevel.item_id, StockLevel.quantity)
+            .where(StockLevel.location_id == location_id, StockLevel.quantity != 0)
+            .order_by(StockLevel.item_id)
+        )
+        items = [{"item_id": r.item_id, "quantity": r.quantity} for r in rows]
+    return {"location_id": location_id, "total": sum(i["quantity"] for i in items), "items": items}
+
+async def _latest_snapshot(session: AsyncSession):
+    return await session.scalar(select(StockSnapshot).order_by(StockSnapshot.cutoff_operation_id.desc()).limit(1))
+
+async def _replay_ledger(session: AsyncSession, snapshot: StockSnapshot | None = None, up_to_id: int | None = None):
+    # Recomputes per-location stock by replaying operations in order, with the same
+    # rules as _apply_operation, starting from a stock snapshot when given. Rows are
+    # streamed, memory is bounded by the number of (item, location) pairs.
+    levels = {}
+    stmt = select(
+        Operation.item_id, Operation.location_id, Operation.from_location_id,
+        Operation.type, Operation.quantity,
+    )
+    if snapshot is not None:
+        levels = {
+            (r.item_id, r.location_id): r.quantity
+            for r in await session.execute(
+                select(StockSnapshotRow.item_id, StockSnapshotRow.location_id, StockSnapshotRow.quantity)
+                .where(StockSnapshotRow.snapshot_id == snapshot.id)
             )
-            session.add(log)
-            await session.flush()
-            return {"status": "synced"}
+        }
+        stmt = stmt.where(Operation.id > snapshot.cutoff_operation_id)
+    if up_to_id is not None:
+        stmt = stmt.where(Operation.id <= up_to_id)
+    result = await session.stream(stmt.order_by(Operation.id).execution_options(yield_per=5000))
+    async for op in result:
+        key = (op.item_id, op.location_id)
+        if op.type == OperationType.receive:
+            levels[key] = levels.get(key, 0) + op.quantity
+        elif op.type == OperationType.ship:
+            levels[key] = levels.get(key, 0) - op.quantity
+        elif op.type == OperationType.inventory:
+            levels[key] = op.quantity
+        elif op.from_location_id is not None:
+            source = (op.item_id, op.from_location_id)
+            levels[source] = levels.get(source, 0) - op.quantity
+            levels[key] = levels.get(key, 0) + op.quantity
+        else:
+            total = 0
+            for other in [k for k in levels if k[0] == op.item_id]:
+                total += levels.pop(other)
+            levels[key] = total
+    return {key: qty for key, qty in levels.items() if qty != 0}
 
-async def register_new_user(registration_data, external_session: AsyncSession = None):
-    # Determine if we're using an external session (e.g., from FastAPI Depends)
-    # or creating a new one for this function.
-    use_external_session = bool(external_session)
-    session = external_session # If external_session is not None, use it
+async def _stock_report(session: AsyncSession, ledger: dict):
+    table = {
+        (r.item_id, r.location_id): r.quantity
+        for r in await session.execute(
+            select(StockLevel.item_id, StockLevel.location_id, StockLevel.quantity).where(StockLevel.quantity != 0)
+        )
+    }
+    level_mismatches = [
+        {"item_id": item_id, "location_id": location_id, "ledger": ledger.get((item_id, location_id), 0),
+         "stock_levels": table.get((item_id, location_id), 0)}
+        for item_id, location_id in sorted(set(ledger) | set(table))
+        if ledger.get((item_id, location_id), 0) != table.get((item_id, location_id), 0)
+    ]
 
-    # If an external session is not provided, create our own.
-    if not use_external_session:
-        session = async_session()
+    ledger_totals = {}
+    for (item_id, _), qty in ledger.items():
+        ledger_totals[item_id] = ledger_totals.get(item_id, 0) + qty
+    item_mismatches = [
+        {"item_id": r.id, "ledger": ledger_totals.get(r.id, 0), "item_quantity": r.quantity}
+        for r in await session.execute(select(Item.id, Item.quantity))
+        if ledger_totals.get(r.id, 0) != r.quantity
+    ]
+    return {
+        "ok": not level_mismatches and not item_mismatches,
+        "stock_level_mismatches": level_mismatches,
+        "item_quantity_mismatches": item_mismatches,
+    }
 
-    try:
-        async with session.begin(): # This block manages the transaction (commit/rollback)
-            existing_user = await session.scalar(select(User).where(User.tg_id == registration_data.tg_id))
-            if existing_user:
-                logger.warning(f"Пользователь с TG ID {registration_data.tg_id} уже зарегистрирован.")
-                raise HTTPException(
-                    status_code=409, # 409 Conflict - resource already exists
-                    detail="Пользователь с таким Telegram ID уже зарегистрирован."
+async def check_stock_levels():
+    async with async_session() as session:
+        ledger = await _replay_ledger(session, await _latest_snapshot(session))
+        return await _stock_report(session, ledger)
+
+async def _unexplained_levels(session: AsyncSession, ledger: dict, snapshot: StockSnapshot | None):
+    # Stock the ledger can't account for: a negative ledger balance (the ledger is missing
+    # earlier receipts), or stock of an item without any operations or snapshot rows.
+    # Rebuilding from the ledger would wipe it, so such positions have to get an
+    # inventory operation first.
+    table = {
+        (r.item_id, r.location_id): r.quantity
+        for r in await session.execute(
+            select(StockLevel.item_id, StockLevel.location_id, StockLevel.quantity).where(StockLevel.quantity != 0)
+        )
+    }
+    unexplained = [
+        (item_id, location_id) for (item_id, location_id), qty in ledger.items()
+        if qty < 0 and table.get((item_id, location_id), 0) != qty
+    ]
+    candidates = sorted({item_id for item_id, location_id in table if (item_id, location_id) not in ledger})
+    with_history = set()
+    for start in range(0, len(candidates), 500):
+        chunk = candidates[start:start + 500]
+        with_history.update(await session.scalars(select(Operation.item_id).where(Operation.item_id.in_(chunk)).distinct()))
+        if snapshot is not None:
+            with_history.update(await session.scalars(
+                select(StockSnapshotRow.item_id)
+                .where(StockSnapshotRow.snapshot_id == snapshot.id, StockSnapshotRow.item_id.in_(chunk))
+                .distinct()
+            ))
+    unexplained += [key for key in table if key not in ledger and key[0] not in with_history]
+    return sorted(unexplained)
+
+async def rebuild_stock_levels():
+    async with write_session() as session:
+        snapshot = await _latest_snapshot(session)
+        ledger = await _replay_ledger(session, snapshot)
+        unexplained = await _unexplained_levels(session, ledger, snapshot)
+        if unexplained:
+            item_id, location_id = unexplained[0]
+            raise HTTPException(
+                status_code=409,
+                detail=f"Пересборка отменена: журнал операций не объясняет остатки {len(unexplained)} позиций "
+                       f"(например, товар {item_id} в локации {location_id}) и обнулил бы их. "
+                       f"Сначала проведите по ним инвентаризацию.",
+            )
+        await session.execute(delete(StockLevel))
+        if ledger:
+            await session.execute(
+                insert(StockLevel),
+                [{"item_id": i, "location_id": loc, "quantity": qty} for (i, loc), qty in ledger.items()],
+            )
+        # Items whose quantity doesn't match the ledger are reported, not changed
+        report = await _stock_report(session, ledger)
+    feed.publish_reset("rebuild")
+    return {"status": "ok", "rows": len(ledger), **report}
+
+# Операции старше LEDGER_RETENTION_DAYS попадают в снимок остатков и уходят в архив
+LEDGER_RETENTION_DAYS = float(os.environ.get("LEDGER_RETENTION_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "1000"))
+SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOT_KEEP", "7"))
+
+async def create_stock_snapshot(before: datetime | None = None):
+    # Snapshot as of the last operation created before `before`, built from the previous
+    # snapshot and the operations after it. Operations up to the cutoff never change, so
+    # the replay runs outside the write transaction.
+    if before is None:
+        # created_at is CURRENT_TIMESTAMP, i.e. UTC
+        before = outbox.utcnow() - timedelta(days=LEDGER_RETENTION_DAYS)
+    async with async_session() as session:
+        cutoff = (await session.execute(
+            select(Operation.id, Operation.created_at)
+            .where(Operation.created_at < _db_timestamp(before))
+            .order_by(Operation.created_at.desc(), Operation.id.desc())
+            .limit(1)
+        )).first()
+        latest = await _latest_snapshot(session)
+        if cutoff is None or (latest is not None and cutoff.id <= latest.cutoff_operation_id):
+            return {"status": "skipped", "snapshot_id": latest.id if latest else None}
+        levels = await _replay_ledger(session, latest, up_to_id=cutoff.id)
+
+    async with write_session() as session:
+        snapshot = StockSnapshot(cutoff_operation_id=cutoff.id, cutoff_at=cutoff.created_at, rows=len(levels))
+        session.add(snapshot)
+        await session.flush()
+        rows = [
+            {"snapshot_id": snapshot.id, "item_id": item_id, "location_id": location_id, "quantity": qty}
+            for (item_id, location_id), qty in levels.items()
+        ]
+        for start in range(0, len(rows), 5000):
+            await session.execute(insert(StockSnapshotRow.__table__), rows[start:start + 5000])
+        # Older snapshots beyond SNAPSHOT_KEEP are no longer needed for replay
+        stale = select(StockSnapshot.id).order_by(StockSnapshot.cutoff_operation_id.desc()).offset(SNAPSHOT_KEEP)
+        stale_ids = (await session.scalars(stale)).all()
+        if stale_ids:
+            await session.execute(delete(StockSnapshotRow).where(StockSnapshotRow.snapshot_id.in_(stale_ids)))
+            await session.execute(delete(StockSnapshot).where(StockSnapshot.id.in_(stale_ids)))
+    logger.info(f"Снимок остатков {snapshot.id}: операции до {cutoff.id}, строк {len(levels)}")
+    return {
+        "status": "ok",
+        "snapshot_id": snapshot.id,
+        "cutoff_operation_id": cutoff.id,
+        "cutoff_at": cutoff.created_at.isoformat(),
+        "rows": len(levels),
+    }
+
+ARCHIVE_COLUMNS = [
+    "id", "user_id", "item_id", "location_id", "from_location_id", "idempotency_key",
+    "type", "quantity", "note", "created_at",
+]
+
+async def archive_operations(batch_size: int = ARCHIVE_BATCH_SIZE):
+    # Moves operations covered by the latest snapshot to operations_archive, one short
+    # transaction per batch so scanners' writes get in between. An operation that is
+    # still an item's last_operation_id stays in place, so that reference stays valid.
+    # Archived idempotency keys are no longer checked: retention is far longer than
+    # any scanner keeps an offline queue.
+    async with async_session() as session:
+        snapshot = await _latest_snapshot(session)
+    if snapshot is None:
+        return {"status": "skipped", "archived": 0}
+
+    archived = 0
+    last_id = 0
+    started = time.perf_counter()
+    while True:
+        async with write_session() as session:
+            ids = (await session.scalars(
+                select(Operation.id)
+                .where(
+                    Operation.id > last_id,
+                    Operation.id <= snapshot.cutoff_operation_id,
+                    ~exists().where(Item.last_operation_id == Operation.id),
                 )
+                .order_by(Operation.id)
+                .limit(batch_size)
+            )).all()
+            if not ids:
+                break
+            await session.execute(
+                insert(ArchivedOperation).from_select(
+                    ARCHIVE_COLUMNS,
+                    select(*(Operation.__table__.c[name] for name in ARCHIVE_COLUMNS)).where(Operation.id.in_(ids)),
+                )
+            )
+            await session.execute(delete(Operation).where(Operation.id.in_(ids)))
+        archived += len(ids)
+        last_id = ids[-1]
+        # Yield to the requests waiting for the write lock
+        await asyncio.sleep(0)
+    logger.info(f"В архив перенесено операций: {archived}")
+    return {
+        "status": "ok",
+        "snapshot_id": snapshot.id,
+        "archived": archived,
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+    }
+
+async def compact_ledger(before: datetime | None = None):
+    snapshot = await create_stock_snapshot(before)
+    archive = await archive_operations()
+    return {"snapshot": snapshot, "archive": archive}
+
+async def fetch_stock_snapshots():
+    async with async_session() as session:
+        snapshots = await session.scalars(select(StockSnapshot).order_by(StockSnapshot.cutoff_operation_id.desc()))
+        return [
+            {
+                "id": s.id,
+                "cutoff_operation_id": s.cutoff_operation_id,
+                "cutoff_at": s.cutoff_at.isoformat(),
+                "rows": s.rows,
+                "created_at": s.created_at.isoformat() if s.created_at else None,
+            }
+            for s in snapshots
+        ]
+
+# Reports without dates cover the last REPORT_DEFAULT_DAYS days
+REPORT_DEFAULT_DAYS = int(os.environ.get("REPORT_DEFAULT_DAYS", "30"))
+
+def _report_period(date_from: date | None, date_to: date | None):
+    # Rollup days are UTC dates, like created_at
+    date_to = date_to or outbox.utcnow().date()
+    date_from = date_from or date_to - timedelta(days=REPORT_DEFAULT_DAYS - 1)
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="Начало периода позже его конца.")
+    return date_from, date_to
 
-            if registration_data.role == UserRole.admin:
-                admin_password = os.environ.get("ADMIN_REGISTRATION_PASSWORD")
-                if not admin_password or registration_data.admin_password != admin_password:
-                    raise HTTPException(status_code=403, detail="Неверный пароль администратора.")
+def _rollup_activity(session: AsyncSession, key, date_from: date, date_to: date, location_id: int | None = None):
+    # Operations and quantities per (key, type) over the period, from the daily rollups
+    stmt = (
+        select(
+            key.label("key"),
+            OperationDailyRollup.type,
+            func.sum(OperationDailyRollup.operations).label("operations"),
+            func.sum(OperationDailyRollup.quantity).label("quantity"),
+        )
+        .where(OperationDailyRollup.day.between(date_from, date_to))
+        .group_by(key, OperationDailyRollup.type)
+    )
+    if location_id is not None:
+        stmt = stmt.where(OperationDailyRollup.location_id == location_id)
+    return session.execute(stmt)
 
-            new_user = User(
-                tg_id=registration_data.tg_id,
-                username=registration_data.username,
-                role=registration_data.role,
+def _group_activity(rows):
+    # {key: {"operations": total, "by_type": {type: {"operations": n, "quantity": q}}}}
+    # Quantities are only summed per type: received and shipped units don't add up
+    groups = {}
+    for r in rows:
+        group = groups.setdefault(r.key, {"operations": 0, "by_type": {}})
+        group["operations"] += r.operations
+        group["by_type"][r.type.value] = {"operations": r.operations, "quantity": r.quantity}
+    return groups
+
+def _period(date_from: date, date_to: date):
+    return {"date_from": date_from.isoformat(), "date_to": date_to.isoformat()}
+
+async def report_locations(date_from: date | None = None, date_to: date | None = None):
+    date_from, date_to = _report_period(date_from, date_to)
+    locations = (await fetch_locations_snapshot()).data
+    async with async_session() as session:
+        stock = {
+            r.location_id: r
+            for r in await session.execute(
+                select(
+                    StockLevel.location_id,
+                    func.count().label("items"),
+                    func.sum(StockLevel.quantity).label("quantity"),
+                )
+                .where(StockLevel.quantity != 0)
+                .group_by(StockLevel.location_id)
             )
-            session.add(new_user)
-
-            await session.flush() # Apply changes to the session, but don't commit to DB yet
-            await session.refresh(new_user) # Load fresh data, including ID
-
-            print(f"Зарегистрирован новый пользователь: {new_user.__dict__}")
-
-            return {
-                "id": new_user.id,
-                "tg_id": new_user.tg_id,
-                "username": new_user.username,
-                "first_name": new_user.first_name,
-                "last_name": new_user.last_name,
-                "last_login": new_user.last_login,
-                "role": new_user.role.value,
-                "is_active": new_user.is_active,
-                "created_at": new_user.created_at.isoformat() if new_user.created_at else None,
+        }
+        activity = _group_activity(await _rollup_activity(session, OperationDailyRollup.location_id, date_from, date_to))
+    empty = {"operations": 0, "by_type": {}}
+    return {
+        **_period(date_from, date_to),
+        "locations": [
+            {
+                "location_id": loc["id"],
+                "name": loc["name"],
+                "code": loc["code"],
+                "items": stock[loc["id"]].items if loc["id"] in stock else 0,
+                "quantity": stock[loc["id"]].quantity if loc["id"] in stock else 0,
+                **activity.get(loc["id"], empty),
+            }
+            for loc in locations
+        ],
+    }
+
+async def report_daily(date_from: date | None = None, date_to: date | None = None, location_id: int | None = None):
+    date_from, date_to = _report_period(date_from, date_to)
+    async with async_session() as session:
+        activity = _group_activity(
+            await _rollup_activity(session, OperationDailyRollup.day, date_from, date_to, location_id)
+        )
+    return {
+        **_period(date_from, date_to),
+        "location_id": location_id,
+        "days": [{"day": day.isoformat(), **activity[day]} for day in sorted(activity)],
+    }
+
+async def report_workers(date_from: date | None = None, date_to: date | None = None, location_id: int | None = None):
+    date_from, date_to = _report_period(date_from, date_to)
+    async with async_session() as session:
+        activity = _group_activity(
+            await _rollup_activity(session, OperationDailyRollup.user_id, date_from, date_to, location_id)
+        )
+        users = {}
+        if activity:
+            users = {
+                u.id: u
+                for u in await session.execute(
+                    select(User.id, User.tg_id, User.username).where(User.id.in_(list(activity)))
+                )
             }
+    workers = [
+        {
+            "user_tg_id": users[user_id].tg_id if user_id in users else None,
+            "username": users[user_id].username if user_id in users else None,
+            **totals,
+        }
+        for user_id, totals in activity.items()
+    ]
+    workers.sort(key=lambda w: w["operations"], reverse=True)
+    return {**_period(date_from, date_to), "location_id": location_id, "workers": workers}
+
+# Дневные итоги операций ведет триггер из migrations.OPERATION_ROLLUPS_DDL. Archiving
+# moves rows out of operations without touching the rollups, reports keep covering the
+# archived period, so a rebuild counts the archive too.
+OPERATION_ROLLUP_FILL = text("""INSERT INTO operation_daily_rollups (day, location_id, type, user_id, operations, quantity)
+    SELECT date(created_at), location_id, type, user_id, count(*), sum(quantity)
+    FROM (
+        SELECT created_at, location_id, type, user_id, quantity FROM operations
+        UNION ALL
+        SELECT created_at, location_id, type, user_id, quantity FROM operations_archive
+    )
+    GROUP BY 1, 2, 3, 4""")
+
+async def rebuild_operation_rollups():
+    # Recomputes the daily rollups from the ledger and the archive. The DELETE takes the
+    # write lock, so operations written meanwhile wait and are counted by the trigger after it
+    async with write_session() as session:
+        await session.execute(delete(OperationDailyRollup))
+        await session.execute(OPERATION_ROLLUP_FILL)
+        rows = await session.scalar(select(func.count()).select_from(OperationDailyRollup))
+    return {"status": "ok", "rows": rows}
+
+EXPORT_CHUNK_ROWS = 1000
+
+ITEM_EXPORT_COLUMNS = [
+    Item.id, Item.barcode, Item.name, Item.sku, Item.quantity, Item.location_id, Item.user_id,
+    Item.description, Item.external_id, Item.status, Item.updated_at, Item.last_operation_id,
+]
+
+OPERATION_EXPORT_COLUMNS = [
+    Operation.id, Operation.created_at, Operation.type, Operation.item_id, Item.barcode.label("item_barcode"),
+    Operation.location_id, Operation.from_location_id, Operation.user_id, Operation.quantity, Operation.note,
+]
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+async def _stream_rows(stmt, fmt: str):
+    # Streams a SELECT as CSV or NDJSON text chunks straight from a server-side cursor,
+    # so memory stays constant and the first chunk goes out before the query is done.
+    columns = [c.key for c in stmt.selected_columns]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(columns)
+        yield buffer.getvalue()
+
+    async with async_session() as session:
+        result = await session.stream(stmt.execution_options(yield_per=EXPORT_CHUNK_ROWS))
+        async for rows in result.partitions():
+            buffer.seek(0)
+            buffer.truncate()
+            for row in rows:
+                values = [_export_value(v) for v in row]
+                if fmt == "csv":
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, values)), ensure_ascii=False))
+                    buffer.write("\n")
+            yield buffer.getvalue()
+
+def export_items(fmt: str = "csv", date_from: datetime | None = None, date_to: datetime | None = None,
+                 location_id: int | None = None):
+    stmt = select(*ITEM_EXPORT_COLUMNS).order_by(Item.id)
+    if date_from is not None:
+        stmt = stmt.where(Item.updated_at >= _db_timestamp(date_from))
+    if date_to is not None:
+        stmt = stmt.where(Item.updated_at < _db_timestamp(date_to))
+    if location_id is not None:
+        stmt = stmt.where(Item.location_id == location_id)
+    return _stream_rows(stmt, fmt)
+
+def export_operations(fmt: str = "csv", date_from: datetime | None = None, date_to: datetime | None = None,
+                      location_id: int | None = None, include_archived: bool = False):
+    def filtered(source, columns):
+        stmt = select(*columns).outerjoin(Item, Item.id == source.item_id)
+        if date_from is not None:
+            stmt = stmt.where(source.created_at >= _db_timestamp(date_from))
+        if date_to is not None:
+            stmt = stmt.where(source.created_at < _db_timestamp(date_to))
+        if location_id is not None:
+            stmt = stmt.where(or_(source.location_id == location_id, source.from_location_id == location_id))
+        return stmt
+
+    stmt = filtered(Operation, OPERATION_EXPORT_COLUMNS)
+    if include_archived:
+        archived_columns = [
+            # Explicit labels: SQLite matches a compound ORDER BY against the first SELECT's aliases
+            getattr(ArchivedOperation, c.key).label(c.key) if c.key != "item_barcode" else c
+            for c in OPERATION_EXPORT_COLUMNS
+        ]
+        stmt = union_all(filtered(ArchivedOperation, archived_columns), stmt).order_by("id")
+    else:
+        stmt = stmt.order_by(Operation.id)
+    return _stream_rows(stmt, fmt)
+
+IMPORT_MAX_ERRORS = 1000
+
+async def _iter_lines(byte_stream):
+    # Splits a streamed request body into text lines without buffering the whole file
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in byte_stream:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending.strip():
+        yield pending.rstrip("\r")
+
+async def _iter_import_records(byte_stream, fmt: str):
+    # Yields (line_number, dict | error message). CSV needs a header row and one record per line.
+    header = None
+    line_no = 0
+    async for line in _iter_lines(byte_stream):
+        line_no += 1
+        if not line.strip():
+            continue
+        try:
+            if fmt == "csv":
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = [h.strip() for h in values]
+                    continue
+                yield line_no, dict(zip(header, values))
+            else:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("ожидается JSON-объект")
+                yield line_no, record
+        except (ValueError, csv.Error) as e:
+            yield line_no, f"Не удалось разобрать строку: {e}"
+
+def _clean_import_record(record: dict, default_user_tg_id: int | None):
+    def text(key):
+        value = record.get(key)
+        if value is None:
+            return None
+        value = str(value).strip()
+        return value or None
+
+    barcode = text("barcode")
+    name = text("name")
+    if not barcode or not name:
+        raise ValueError("Поля barcode и name обязательны.")
+    quantity = int(text("quantity") or 0)
+    if quantity < 0:
+        raise ValueError("Количество не может быть отрицательным.")
+    location_id = text("location_id")
+    location_code = text("location_code")
+    if not location_id and not location_code:
+        raise ValueError("Локация (location_id или location_code) должна быть указана.")
+    user_tg_id = text("user_tg_id")
+    if not user_tg_id and default_user_tg_id is None:
+        raise ValueError("Не указан пользователь (user_tg_id).")
+    return {
+        "barcode": barcode,
+        "name": name,
+        "sku": text("sku"),
+        "quantity": quantity,
+        "description": text("description") or text("note"),
+        "external_id": text("external_id"),
+        "location_id": int(location_id) if location_id else None,
+        "location_code": location_code,
+        "user_tg_id": int(user_tg_id) if user_tg_id else default_user_tg_id,
+    }
+
+async def _import_chunk(chunk, seen_barcodes: set, errors: list):
+    # Resolves references for a whole chunk with a few IN (...) queries and inserts the
+    # valid rows with executemany in one transaction. Returns the number of imported rows.
+    location_ids = {r["location_id"] for _, r in chunk if r["location_id"] is not None}
+    location_codes = {r["location_code"] for _, r in chunk if r["location_id"] is None}
+    tg_ids = {r["user_tg_id"] for _, r in chunk}
+    barcodes = {r["barcode"] for _, r in chunk}
+
+    def fail(line_no, record, detail):
+        if len(errors) < IMPORT_MAX_ERRORS:
+            errors.append({"line": line_no, "barcode": record.get("barcode"), "detail": detail})
+
+    async with write_session() as session:
+        known_locations = set(await session.scalars(select(Location.id).where(Location.id.in_(location_ids))))
+        codes = {
+            r.code: r.id
+            for r in await session.execute(select(Location.code, Location.id).where(Location.code.in_(location_codes)))
+        }
+        users = {
+            r.tg_id: r.id
+            for r in await session.execute(select(User.tg_id, User.id).where(User.tg_id.in_(tg_ids)))
+        }
+        existing = set(await session.scalars(select(Item.barcode).where(Item.barcode.in_(barcodes))))
+
+        rows = []
+        for line_no, record in chunk:
+            location_id = record["location_id"] if record["location_id"] is not None else codes.get(record["location_code"])
+            if record["barcode"] in existing or record["barcode"] in seen_barcodes:
+                fail(line_no, record, "Товар с таким штрихкодом уже существует.")
+            elif location_id is None or (record["location_id"] is not None and location_id not in known_locations):
+                fail(line_no, record, "Указанная локация не найдена.")
+            elif record["user_tg_id"] not in users:
+                fail(line_no, record, "Пользователь Telegram не найден в базе данных.")
+            else:
+                seen_barcodes.add(record["barcode"])
+                rows.append({
+                    "barcode": record["barcode"],
+                    "name": record["name"],
+                    "sku": record["sku"],
+                    "quantity": record["quantity"],
+                    "description": record["description"],
+                    "external_id": record["external_id"],
+                    "location_id": location_id,
+                    "user_id": users[record["user_tg_id"]],
+                })
+        if not rows:
+            return 0
+
+        # Plain executemany (no RETURNING, which SQLite would run row by row),
+        # then the new IDs are read back with one indexed IN (...) query
+        await session.execute(insert(Item.__table__), rows)
+        ids = {
+            r.barcode: r.id
+            for r in await session.execute(
+                select(Item.barcode, Item.id).where(Item.barcode.in_([r["barcode"] for r in rows]))
+            )
+        }
+        # Opening quantities go through the ledger, same as in create_item
+        stocked = [r for r in rows if r["quantity"]]
+        if stocked:
+            await session.execute(
+                insert(Operation.__table__),
+                [
+                    {
+                        "user_id": r["user_id"],
+                        "item_id": ids[r["barcode"]],
+                        "location_id": r["location_id"],
+                        "type": OperationType.receive,
+                        "quantity": r["quantity"],
+                        "note": "Начальный остаток",
+                    }
+                    for r in stocked
+                ],
+            )
+            await session.execute(
+                insert(StockLevel.__table__),
+                [{"item_id": ids[r["barcode"]], "location_id": r["location_id"], "quantity": r["quantity"]} for r in stocked],
+            )
+            stocked_ids = [ids[r["barcode"]] for r in stocked]
+            await session.execute(
+                update(Item)
+                .where(Item.id.in_(stocked_ids))
+                .values(
+                    last_operation_id=select(func.max(Operation.id))
+                    .where(Operation.item_id == Item.id)
+                    .scalar_subquery()
+                )
+                .execution_options(synchronize_session=False)
+            )
+
+        if outbox.ENABLED:
+            await session.execute(insert(OutboxEvent.__table__), [
+                outbox.outbox_event("item", ids[r["barcode"]], "item.created", {"id": ids[r["barcode"]], **r})
+                for r in rows
+            ])
+
+    outbox.notify()
+    item_cache.invalidate(*ids)
+    return len(rows)
+
+async def import_items(byte_stream, fmt: str = "csv", user_tg_id: int | None = None, chunk_size: int = 1000):
+    started = time.perf_counter()
+    errors = []
+    seen_barcodes = set()
+    total = 0
+    imported = 0
+    chunk = []
+
+    async def flush_chunk():
+        nonlocal imported
+        try:
+            imported += await _import_chunk(chunk, seen_barcodes, errors)
+        except IntegrityError as e:
+            # A concurrent insert of the same barcode: the whole chunk is rolled back
+            logger.error(f"Ошибка импорта пачки товаров: {e}")
+            for line_no, record in chunk:
+                seen_barcodes.discard(record["barcode"])
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append({"line": line_no, "barcode": record["barcode"], "detail": "Ошибка записи пачки, повторите импорт."})
+        chunk.clear()
+
+    async for line_no, record in _iter_import_records(byte_stream, fmt):
+        total += 1
+        if isinstance(record, str):
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_no, "barcode": None, "detail": record})
+            continue
+        try:
+            chunk.append((line_no, _clean_import_record(record, user_tg_id)))
+        except ValueError as e:
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_no, "barcode": record.get("barcode"), "detail": str(e)})
+            continue
+        if len(chunk) >= chunk_size:
+            await flush_chunk()
+    if chunk:
+        await flush_chunk()
+
+    if imported:
+        feed.publish_reset("import")
+    elapsed = time.perf_counter() - started
+    return {
+        "status": "ok",
+        "rows_total": total,
+        "imported": imported,
+        "failed": total - imported,
+        "errors": errors,
+        "errors_truncated": total - imported > len(errors),
+        "elapsed_seconds": round(elapsed, 3),
+        "rows_per_second": round(total / elapsed, 1) if elapsed else None,
+    }
+
+async def open_inventory_count(data):
+    async with write_session() as session:
+        user = await fetch_user_by_tg_id(data.user_tg_id, session)
+        if not user:
+            raise HTTPException(status_code=404, detail="Пользователь не найден.")
+        if not await session.get(Location, data.location_id):
+            raise HTTPException(status_code=404, detail="Локация не найдена.")
+        count = InventoryCount(location_id=data.location_id, user_id=user.id, note=data.note)
+        session.add(count)
+        try:
+            await session.flush()
+        except IntegrityError:
+            raise HTTPException(status_code=409, detail="Для этой локации уже открыта инвентаризация.")
+        await session.refresh(count)
+    return serialize_inventory_count(count)
+
+async def fetch_inventory_count(count_id: int):
+    async with async_session() as session:
+        count = await session.get(InventoryCount, count_id)
+        if not count:
+            raise HTTPException(status_code=404, detail="Инвентаризация не найдена.")
+        lines = await session.scalar(
+            select(func.count()).select_from(InventoryCountLine).where(InventoryCountLine.count_id == count_id)
+        )
+    return {**serialize_inventory_count(count), "lines": lines}
+
+async def _raise_count_not_open(session: AsyncSession, count_id: int):
+    # The guarded UPDATE matched nothing: tell a missing count from a finished one
+    if await session.get(InventoryCount, count_id) is None:
+        raise HTTPException(status_code=404, detail="Инвентаризация не найдена.")
+    raise HTTPException(status_code=409, detail="Инвентаризация уже закрыта или отменена.")
+
+async def _lock_open_count(session: AsyncSession, count_id: int, **values):
+    # Writes first, so the transaction waits for the write lock (busy_timeout) instead of
+    # failing on a lock upgrade after reading, and a closed count stops taking changes
+    row = (await session.execute(
+        update(InventoryCount)
+        .where(InventoryCount.id == count_id, InventoryCount.status == InventoryCountStatus.open)
+        .values(**values)
+        .returning(InventoryCount.location_id, InventoryCount.user_id)
+        .execution_options(synchronize_session=False)
+    )).first()
+    if row is None:
+        await _raise_count_not_open(session, count_id)
+    return row
+
+async def add_inventory_count_lines(count_id: int, byte_stream, fmt: str = "csv", replace: bool = False, chunk_size: int = 1000):
+    # Counted barcodes stream in as CSV/NDJSON records {barcode, quantity}; quantity
+    # defaults to 1 (one scan). Repeats of a barcode add up, with replace=True the last
+    # record wins (a recount). Each chunk is aggregated in memory and upserted into the
+    # staging table with one executemany.
+    errors = []
+    total = 0
+    accepted = 0
+    chunk = {}
+    records = 0
+
+    async def flush_chunk():
+        nonlocal records
+        async with write_session() as session:
+            await _lock_open_count(session, count_id, scanned=InventoryCount.scanned + records)
+            stmt = sqlite_insert(InventoryCountLine.__table__)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["count_id", "barcode"],
+                set_={"quantity": stmt.excluded.quantity if replace else InventoryCountLine.quantity + stmt.excluded.quantity},
+            )
+            await session.execute(stmt, [
+                {"count_id": count_id, "barcode": barcode, "quantity": quantity}
+                for barcode, quantity in chunk.items()
+            ])
+        chunk.clear()
+        records = 0
+
+    async for line_no, record in _iter_import_records(byte_stream, fmt):
+        total += 1
+        if isinstance(record, str):
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_no, "barcode": None, "detail": record})
+            continue
+        barcode = str(record.get("barcode") or "").strip()
+        quantity = record.get("quantity")
+        try:
+            quantity = 1 if quantity in (None, "") else int(quantity)
+            if not barcode:
+                raise ValueError("Поле barcode обязательно.")
+            if quantity < 0:
+                raise ValueError("Количество не может быть отрицательным.")
+        except ValueError as e:
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_no, "barcode": barcode or None, "detail": str(e)})
+            continue
+        chunk[barcode] = quantity if replace else chunk.get(barcode, 0) + quantity
+        records += 1
+        accepted += 1
+        if records >= chunk_size:
+            await flush_chunk()
+    if chunk:
+        await flush_chunk()
+
+    return {
+        "status": "ok",
+        "count_id": count_id,
+        "rows_total": total,
+        "accepted": accepted,
+        "failed": total - accepted,
+        "errors": errors,
+        "errors_truncated": total - accepted > len(errors),
+    }
+
+async def close_inventory_count(count_id: int, zero_uncounted: bool = True):
+    # Reconciles the count with stock_levels in a fixed number of set-based statements,
+    # whatever the number of lines: resolve barcodes and current stock in the staging
+    # table, then write all adjusting inventory operations, stock rows, item totals and
+    # outbox events with INSERT ... SELECT / UPDATE ... FROM. With zero_uncounted, items
+    # stocked at the location but not counted are adjusted to 0 (a full count).
+    line = InventoryCountLine
+    async with write_session() as session:
+        location_id, user_id = await _lock_open_count(
+            session, count_id, status=InventoryCountStatus.closed, closed_at=func.now()
+        )
+        await session.execute(
+            update(line)
+            .where(line.count_id == count_id)
+            .values(item_id=select(Item.id).where(Item.barcode == line.barcode).scalar_subquery())
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(
+            update(line)
+            .where(line.count_id == count_id, line.item_id.is_not(None))
+            .values(expected=func.coalesce(
+                select(StockLevel.quantity)
+                .where(StockLevel.item_id == line.item_id, StockLevel.location_id == location_id)
+                .scalar_subquery(),
+                0,
+            ))
+            .execution_options(synchronize_session=False)
+        )
+        uncounted = 0
+        if zero_uncounted:
+            result = await session.execute(
+                insert(line).from_select(
+                    ["count_id", "barcode", "quantity", "item_id", "expected"],
+                    select(literal(count_id), Item.barcode, literal(0), Item.id, StockLevel.quantity)
+                    .join_from(StockLevel, Item, Item.id == StockLevel.item_id)
+                    .where(
+                        StockLevel.location_id == location_id,
+                        StockLevel.quantity != 0,
+                        # By barcode: (count_id, barcode) is the staging table's primary key
+                        ~exists().where(line.count_id == count_id, line.barcode == Item.barcode),
+                    ),
+                )
+            )
+            uncounted = result.rowcount
+
+        changed = (line.count_id == count_id, line.item_id.is_not(None), line.quantity != line.expected)
+        # Operations written below get ids above this one: the write lock is held since _lock_open_count
+        last_id = await session.scalar(select(func.coalesce(func.max(Operation.id), 0)))
+        note = f"Инвентаризация #{count_id}"
+        adjusted = (await session.execute(
+            insert(Operation).from_select(
+                ["user_id", "item_id", "location_id", "type", "quantity", "note"],
+                select(
+                    literal(user_id), line.item_id, literal(location_id),
+                    literal(OperationType.inventory, Operation.__table__.c.type.type), line.quantity, literal(note),
+                )
+                .where(*changed)
+                .order_by(line.item_id),
+            )
+        )).rowcount
+        if adjusted:
+            upsert = sqlite_insert(StockLevel).from_select(
+                ["item_id", "location_id", "quantity"],
+                select(line.item_id, literal(location_id), line.quantity).where(*changed),
+            )
+            await session.execute(upsert.on_conflict_do_update(
+                index_elements=[StockLevel.item_id, StockLevel.location_id],
+                set_={"quantity": upsert.excluded.quantity, "updated_at": func.now()},
+            ))
+            # Same rule as a single inventory operation: the item total moves by the difference
+            await session.execute(
+                update(Item)
+                .where(Item.id == line.item_id, *changed)
+                .values(
+                    quantity=Item.quantity + line.quantity - line.expected,
+                    last_operation_id=select(func.max(Operation.id))
+                    .where(Operation.item_id == Item.id)
+                    .scalar_subquery(),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            if outbox.ENABLED:
+                user_tg_id = await session.scalar(select(User.tg_id).where(User.id == user_id))
+                await session.execute(insert(OutboxEvent).from_select(
+                    ["entity_type", "entity_id", "event", "payload", "idempotency_key"],
+                    select(
+                        literal("operation"),
+                        Operation.id,
+                        literal("operation.created"),
+                        func.json_object(
+                            "operation_id", Operation.id,
+                            "type", OperationType.inventory.value,
+                            "item_id", Operation.item_id,
+                            "barcode", Item.barcode,
+                            "location_id", Operation.location_id,
+                            "from_location_id", None,
+                            "user_tg_id", user_tg_id,
+                            "quantity", Operation.quantity,
+                            "note", Operation.note,
+                            "item_quantity", Item.quantity,
+                            "item_location_id", Item.location_id,
+                        ),
+                        func.lower(func.hex(func.randomblob(16))),
+                    )
+                    .join_from(Operation, Item, Item.id == Operation.item_id)
+                    .where(Operation.id > last_id),
+                ))
+        await session.execute(
+            update(InventoryCount)
+            .where(InventoryCount.id == count_id)
+            .values(adjusted=adjusted, uncounted=uncounted)
+            .execution_options(synchronize_session=False)
+        )
+        report = await _inventory_report(session, count_id)
+
+    if adjusted:
+        outbox.notify()
+        item_cache.invalidate(*(d["barcode"] for d in report["discrepancies"]))
+        # Bulk change, announced once like an import
+        feed.publish_reset("inventory")
+    return report
+
+async def fetch_inventory_report(count_id: int):
+    async with async_session() as session:
+        count = await session.get(InventoryCount, count_id)
+        if not count:
+            raise HTTPException(status_code=404, detail="Инвентаризация не найдена.")
+        if count.status != InventoryCountStatus.closed:
+            raise HTTPException(status_code=409, detail="Отчет доступен после закрытия инвентаризации.")
+        return await _inventory_report(session, count_id)
+
+async def _inventory_report(session: AsyncSession, count_id: int):
+    # Variance report of a closed count, read back from the resolved staging lines
+    line = InventoryCountLine
+    # Reloaded: the closing UPDATEs bypassed the identity map
+    count = (await session.execute(
+        select(InventoryCount).where(InventoryCount.id == count_id).execution_options(populate_existing=True)
+    )).scalar_one()
+    lines = await session.scalar(select(func.count()).select_from(line).where(line.count_id == count_id))
+    discrepancies = [
+        {
+            "item_id": r.item_id,
+            "barcode": r.barcode,
+            "name": r.name,
+            "expected": r.expected,
+            "counted": r.quantity,
+            "difference": r.quantity - r.expected,
+        }
+        for r in await session.execute(
+            select(line.item_id, line.barcode, Item.name, line.expected, line.quantity)
+            .join(Item, Item.id == line.item_id)
+            .where(line.count_id == count_id, line.quantity != line.expected)
+            .order_by(line.item_id)
+        )
+    ]
+    unknown = [
+        {"barcode": r.barcode, "counted": r.quantity}
+        for r in await session.execute(
+            select(line.barcode, line.quantity).where(line.count_id == count_id, line.item_id.is_(None))
+        )
+    ]
+    return {
+        **serialize_inventory_count(count),
+        "lines": lines,
+        "matched": lines - len(discrepancies) - len(unknown),
+        "surplus": sum(d["difference"] for d in discrepancies if d["difference"] > 0),
+        "shortage": -sum(d["difference"] for d in discrepancies if d["difference"] < 0),
+        "discrepancies": discrepancies,
+        "unknown_barcodes": unknown,
+    }
+
+async def cancel_inventory_count(count_id: int):
+    async with write_session() as session:
+        await _lock_open_count(session, count_id, status=InventoryCountStatus.cancelled, closed_at=func.now())
+        await session.execute(delete(InventoryCountLine).where(InventoryCountLine.count_id == count_id))
+    return {"status": "ok", "count_id": count_id}
+
+async def log_sync(data):
+    # Ручной запрос на выгрузку сущности в 1С: событие ставится в outbox, отправляет его
+    # фоновый воркер, а результат отправки пишется в SyncLog.
+    if not outbox.ENABLED:
+        raise HTTPException(status_code=503, detail="Выгрузка в 1С не настроена: SYNC_SINK не задан.")
+    async with write_session() as session:
+        event = outbox.outbox_event(data.entity_type, data.entity_id, "sync.requested", {"message": data.message})
+        await session.execute(insert(OutboxEvent), [event])
+    outbox.notify()
+    return {"status": "queued", "idempotency_key": event["idempotency_key"]}
+
+async def register_new_user(registration_data, external_session: AsyncSession = None):
+    # An external session (e.g., from FastAPI Depends) manages its own transaction;
+    # otherwise the registration goes through the single writer like every other write.
+    try:
+        if external_session:
+            async with external_session.begin(): # This block manages the transaction (commit/rollback)
+                new_user = await _insert_user(external_session, registration_data)
+        else:
+            async with write_session() as session:
+                new_user = await _insert_user(session, registration_data)
+
+        # The cached "not found" for this tg_id must go once the user is committed
+        reference_cache.invalidate(("user", new_user.tg_id))
+        return serialize_user(new_user)
     except Exception as e:
         logger.error(f"Ошибка при регистрации пользователя в requests.py: {e}")
         raise # Re-raise the exception to be caught by main.py's handler
-    finally:
-        if not use_external_session:
-            await session.close() # Close session only if we created it
+
+async def _insert_user(session: AsyncSession, registration_data) -> User:
+    existing_user = await session.scalar(select(User).where(User.tg_id == registration_data.tg_id))
+    if existing_user:
+        logger.warning(f"Пользователь с TG ID {registration_data.tg_id} уже зарегистрирован.")
+        raise HTTPException(
+            status_code=409, # 409 Conflict - resource already exists
+            detail="Пользователь с таким Telegram ID уже зарегистрирован."
+        )
+
+    if registration_data.role == UserRole.admin:
+        admin_password = os.environ.get("ADMIN_REGISTRATION_PASSWORD")
+        if not admin_password or registration_data.admin_password != admin_password:
+            raise HTTPException(status_code=403, detail="Неверный пароль администратора.")
+
+    new_user = User(
+        tg_id=registration_data.tg_id,
+        username=registration_data.username,
+        role=registration_data.role,
+    )
+    session.add(new_user)
+
+    await session.flush() # Apply changes to the session, but don't commit to DB yet
+    await session.refresh(new_user) # Load fresh data, including ID
+
+    print(f"Зарегистрирован новый пользователь: {new_user.__dict__}")
+    return new_user
+
+def serialize_user(user: User):
+    return {
+        "id": user.id,
+        "tg_id": user.tg_id,
+        "username": user.username,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "last_login": user.last_login.isoformat() if user.last_login else None,
+        "role": user.role.value,
+        "is_active": user.is_active,
+        "created_at": user.created_at.isoformat() if user.created_at else None,
+    }
+
+def serialize_location(location: Location):
+    return {"id": location.id, "name": location.name, "code": location.code, "description": location.description}
 
 def serialize_item(item: Item):
     return {
@@ -301,4 +1896,31 @@ def serialize_item(item: Item):
         "status": item.status,
         "updated_at": item.updated_at.isoformat() if item.updated_at else None,
         "last_operation_id": item.last_operation_id,
-    }
\ No newline at end of file
+    }
+
+def serialize_inventory_count(count: InventoryCount):
+    return {
+        "id": count.id,
+        "location_id": count.location_id,
+        "status": count.status.value,
+        "note": count.note,
+        "scanned": count.scanned,
+        "adjusted": count.adjusted,
+        "uncounted": count.uncounted,
+        "created_at": count.created_at.isoformat() if count.created_at else None,
+        "closed_at": count.closed_at.isoformat() if count.closed_at else None,
+    }
+
+def serialize_operation(operation: Operation):
+    return {
+        "id": operation.id,
+        "user_id": operation.user_id,
+        "item_id": operation.item_id,
+        "location_id": operation.location_id,
+        "type": operation.type.value,
+        "quantity": operation.quantity,
+        "note": operation.note,
+        "from_location_id": operation.from_location_id,
+        "idempotency_key": operation.idempotency_key,
+        "created_at": operation.created_at.isoformat() if operation.created_at else None,
+    }
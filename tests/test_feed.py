@@ -0,0 +1,44 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import feed
+
+
+async def frames(feed_, subscription, count):
+    stream = feed_.stream(subscription)
+    result = [await anext(stream) for _ in range(count + 1)][1:]  # skips "retry:"
+    await stream.aclose()
+    return result
+
+
+def test_dropped_subscriber_resumes_with_reset_when_gap_exceeds_queue(monkeypatch):
+    monkeypatch.setattr(feed, "FEED_QUEUE_SIZE", 4)
+    stock_feed = feed.StockFeed()
+    last_seen = f"{stock_feed.boot}-{stock_feed.seq}"
+    slow = stock_feed.subscribe()
+    for n in range(10):
+        stock_feed.publish("stock", {"n": n}, item_id=1)
+    assert asyncio.run(frames(stock_feed, slow, 1)) == ["event: dropped\ndata: {}\n\n"]
+
+    resumed = stock_feed.subscribe(last_event_id=last_seen)
+    assert not resumed.dropped
+    assert resumed in stock_feed.subscribers
+    stock_feed.publish("stock", {"n": 10}, item_id=1)
+    first, second = asyncio.run(frames(stock_feed, resumed, 2))
+    assert first == 'event: reset\ndata: {"reason":"backlog"}\n\n'
+    assert second.startswith(f"id: {stock_feed.boot}-11\n")
+
+
+def test_subscriber_resumes_with_missed_events(monkeypatch):
+    monkeypatch.setattr(feed, "FEED_QUEUE_SIZE", 4)
+    stock_feed = feed.StockFeed()
+    stock_feed.publish("stock", {"n": 0}, item_id=1)
+    last_seen = f"{stock_feed.boot}-{stock_feed.seq}"
+    stock_feed.publish("stock", {"n": 1}, item_id=1)
+    stock_feed.publish("stock", {"n": 2}, item_id=2)
+
+    resumed = stock_feed.subscribe(item_ids=[1], last_event_id=last_seen)
+    assert asyncio.run(frames(stock_feed, resumed, 1)) == [f'id: {stock_feed.boot}-2\nevent: stock\ndata: {{"n":1}}\n\n']
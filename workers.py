@@ -0,0 +1,142 @@
+"""
+Режим нескольких процессов uvicorn.
+
+    WEB_CONCURRENCY=4 uvicorn main:app --host 0.0.0.0 --port 8000
+
+(uvicorn takes --workers from WEB_CONCURRENCY, so the app knows how many copies of it
+run on the same db.sqlite3.) Reads are served by any worker: in WAL mode readers don't
+block the writer or each other. Every write transaction goes through
+database.write_session: one writer per process behind an asyncio.Lock, and across
+processes the SQLite write lock itself, taken with BEGIN IMMEDIATE and retried with
+backoff, so workers queue for it instead of failing with "database is locked".
+
+Work that must run once per deployment (outbox delivery to 1C, ledger compaction) runs
+on the leader only: the worker holding the "leader" row of worker_leases. The lease is
+renewed every WORKER_LEASE_TTL / 3 seconds; if the leader dies, another worker takes
+over once the lease expires. A leader that stops cleanly releases it right away.
+
+Per-process state is kept consistent through files in WORKER_SHARED_DIR (next to the
+database by default): cache invalidations (cache.TTLCache.share) and the stock feed
+relay (feed.FeedRelay).
+"""
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from dotenv import load_dotenv
+
+from database import DATABASE_URL, write_session
+from models import WorkerLease
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+MULTI_WORKER = WORKERS > 1
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+WORKER_LEASE_TTL = float(os.environ.get("WORKER_LEASE_TTL", "30"))  # seconds
+
+
+def shared_dir() -> str:
+    """Каталог для файлов, общих для процессов одной БД; создается при первом вызове."""
+    path = os.environ.get("WORKER_SHARED_DIR")
+    if not path:
+        database = DATABASE_URL.split("///", 1)[-1].split("?", 1)[0]
+        path = f"{database}.shared"
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class LeaderLease:
+    """
+    Аренда роли ведущего процесса.
+
+    `on_acquire()` runs when this worker becomes the leader, `on_release()` when it loses
+    the lease (it couldn't renew in time) or stops. Both are coroutines.
+    """
+
+    def __init__(self, on_acquire, on_release, name: str = "leader", ttl: float = WORKER_LEASE_TTL):
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.name = name
+        self.ttl = ttl
+        self.is_leader = False
+        self.renewals = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            self.is_leader = False
+            await self.on_release()
+            await self.release()
+
+    async def run(self):
+        while True:
+            try:
+                held = await self.acquire()
+            except Exception as e:
+                logger.error(f"Не удалось продлить аренду {self.name}: {e}")
+                held = False
+            if held and not self.is_leader:
+                self.is_leader = True
+                logger.info(f"Процесс {WORKER_ID} стал ведущим")
+                await self.on_acquire()
+            elif not held and self.is_leader:
+                self.is_leader = False
+                logger.warning(f"Процесс {WORKER_ID} потерял аренду {self.name}")
+                await self.on_release()
+            await asyncio.sleep(self.ttl / 3)
+
+    async def acquire(self) -> bool:
+        # Takes a free or expired lease, or renews our own, in one statement: RETURNING
+        # yields no row when the conflicting lease belongs to a live owner
+        now = utcnow()
+        statement = sqlite_insert(WorkerLease).values(
+            name=self.name, owner=WORKER_ID, expires_at=now + timedelta(seconds=self.ttl),
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[WorkerLease.name],
+            set_={"owner": statement.excluded.owner, "expires_at": statement.excluded.expires_at},
+            where=or_(WorkerLease.owner == WORKER_ID, WorkerLease.expires_at < now),
+        ).returning(WorkerLease.owner)
+        async with write_session() as session:
+            owner = await session.scalar(statement)
+        if owner == WORKER_ID:
+            self.renewals += 1
+            return True
+        return False
+
+    async def release(self):
+        try:
+            async with write_session() as session:
+                await session.execute(
+                    delete(WorkerLease).where(WorkerLease.name == self.name, WorkerLease.owner == WORKER_ID)
+                )
+        except Exception as e:
+            # Expires on its own after the TTL
+            logger.warning(f"Не удалось освободить аренду {self.name}: {e}")
+
+    def stats(self):
+        return {"worker_id": WORKER_ID, "workers": WORKERS, "leader": self.is_leader, "renewals": self.renewals}
+
+
+# Set by main.py on startup in multi-worker mode
+lease: LeaderLease | None = None